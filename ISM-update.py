@@ -2,18 +2,28 @@
 import os
 import json
 import logging
-import time
 
 import pandas as pd
 import gspread
 from oauth2client.service_account import ServiceAccountCredentials
-from gspread_dataframe import set_with_dataframe
+
+from sync_cdc import capture_changes
+from sync_versions import source_versions, sources_unchanged, mark_synced, claim_destination
+from sync_filters import apply_job_filters
+from sync_strategies import read_columns
+from sync_profile import profile_job
+from sheets_io import (
+    Deadline, api_retry_open, api_retry_worksheet, destination_lock, write_call, write_dataframe,
+)
 
 # —————————————————————————————
 # Константы
+JOB_NAME = "ISM-update"
+
 
 SRC_SS_ID     = "1MBVdG-_8Bza_H5elN8rSABxSAdBqUtgpsXyS4BcRhV8"
 SRC_SHEET_GID = 2063311651  # int
+SRC_COLS      = [2, 4, 11, 28]  # C, E, L, AC
 
 DST_SS_ID       = "1SudB1YkPD0Tt7xkEiNJypRv0vb62BSdsCLrcrGqALAI"
 DST_SHEET_TITLE = "ism_communications"
@@ -45,25 +55,18 @@ def get_worksheet_by_gid(spreadsheet, gid: int):
         raise ValueError(f"Worksheet with gid={gid} not found")
 
 
-def read_sheet_as_dataframe(client, ss_id: str, gid: int) -> pd.DataFrame:
+def read_sheet_as_dataframe(client, ss_id: str, gid: int, deadline=None, cols=None) -> pd.DataFrame:
+    """Колонки cols листа (по умолчанию потоковым values.get, см. sync_strategies)."""
     logging.info(f"Opening source spreadsheet: {ss_id}")
-    sh = client.open_by_key(ss_id)
+    sh = api_retry_open(client, ss_id, deadline)
     ws = get_worksheet_by_gid(sh, gid)
 
-    logging.info(f"Reading worksheet: '{ws.title}' (gid={gid})")
-    values = ws.get_all_values()
-
-    if not values:
-        logging.warning("Source sheet is empty")
-        return pd.DataFrame()
-
-    # Выравниваем строки по длине
-    max_len = max(len(r) for r in values)
-    values = [r + [""] * (max_len - len(r)) for r in values]
+    # Проверяем, что нужные колонки (AC) в листе вообще есть — по сетке, до чтения и при любом способе чтения
+    if cols and ws.col_count <= max(cols):
+        raise ValueError(f"Source has only {ws.col_count} columns, but need index {max(cols)}")
 
-    header = values[0]
-    rows = values[1:]
-    df = pd.DataFrame(rows, columns=header)
+    logging.info(f"Reading worksheet: '{ws.title}' (gid={gid})")
+    df = read_columns(ws, cols, deadline, prefer="values_stream")
 
     logging.info(f"Parsed DataFrame shape: {df.shape}")
     return df
@@ -72,38 +75,45 @@ def read_sheet_as_dataframe(client, ss_id: str, gid: int) -> pd.DataFrame:
 def main():
     client = get_gspread_client()
     logging.info("✔ Authenticated to Google Sheets")
+    deadline = Deadline.from_env(JOB_NAME)
+
+    # Источники не менялись с прошлой успешной синхронизации — не читаем и не пишем
+    src_versions = source_versions(client, JOB_NAME, deadline)
+    if sources_unchanged(JOB_NAME, src_versions):
+        logging.info("✔ Sources unchanged since last sync — skipping fetch and write")
+        return
 
     # ВАЖНО: service account должен иметь доступ к ИСТОЧНИКУ и ЦЕЛЕВОЙ таблице
     logging.info(f"Service account email: {SERVICE_ACCOUNT_JSON.get('client_email')}")
 
     # 1) Читаем источник
-    df_all = read_sheet_as_dataframe(client, SRC_SS_ID, SRC_SHEET_GID)
+    # Читаем только колонки C, E, L, AC (индексы 2, 4, 11, 28)
+    #    (ширину листа — есть ли AC — проверяет read_sheet_as_dataframe до чтения)
+    df = read_sheet_as_dataframe(client, SRC_SS_ID, SRC_SHEET_GID, deadline, SRC_COLS)
+    df = apply_job_filters(JOB_NAME, 0, df)
 
-    if df_all.empty:
+    if df.empty:
         raise ValueError("Source dataframe is empty")
-
-    # 2) Выбираем колонки C, E, L, AC (индексы 2, 4, 11, 28)
-    need_idx = [2, 4, 11, 28]
-    if df_all.shape[1] <= max(need_idx):
-        raise ValueError(
-            f"Source has only {df_all.shape[1]} columns, but need index {max(need_idx)} (AC)"
-        )
-
-    df = df_all.iloc[:, need_idx].copy()
     logging.info(f"→ Selected columns C,E,L,AC → shape {df.shape}")
 
     # (опционально) можно переименовать колонки
     # df.columns = ["col_C", "col_E", "col_L", "col_AC"]
 
     # 3) Записываем в целевой лист
-    sh_dst = client.open_by_key(DST_SS_ID)
-    ws_dst = sh_dst.worksheet(DST_SHEET_TITLE)
+    sh_dst = api_retry_open(client, DST_SS_ID, deadline, write=True)
+    ws_dst = api_retry_worksheet(sh_dst, DST_SHEET_TITLE, deadline)
 
-    ws_dst.clear()
-    set_with_dataframe(ws_dst, df, include_index=False, include_column_header=True)
+    with destination_lock(DST_SS_ID, DST_SHEET_TITLE):
+        write_deadline = deadline.write_phase()   # до очистки: хватит ли бюджета, дальше — свой
+        claim_destination(JOB_NAME)   # с этого момента лист наш, пока не mark_synced
+        write_call(ws_dst.clear, write_deadline, ws_dst.client)
+        write_dataframe(ws_dst, df, include_column_header=True, deadline=write_deadline)
+    capture_changes(JOB_NAME, df)
+    mark_synced(JOB_NAME, src_versions)
 
     logging.info(f"✔ Written to '{DST_SHEET_TITLE}' — {df.shape[0]} rows")
 
 
 if __name__ == "__main__":
-    main()
+    with profile_job(JOB_NAME):
+        main()
@@ -0,0 +1,276 @@
+#!/usr/bin/env python3
+"""
+Микробенчмарки CPU-стадий без сети: транспонирование batch_get_columns
+с normalize_frame на ширине каждого скрипта, разбор ответа values.get для ISM (целиком против потокового),
+нормализация и SpillDedupe из QA-update (в памяти и со сбросом на диск), хэши строк,
+дедупликация и сериализация
+payload (set_with_dataframe против write_dataframe). Данные синтетические, с фиксированным seed.
+
+    python bench_transforms.py --sizes 10000,100000 --save bench_baseline.json
+    python bench_transforms.py --compare bench_baseline.json --threshold 1.3
+"""
+import os
+import gc
+import sys
+import json
+import time
+import random
+import logging
+import argparse
+import tempfile
+import tracemalloc
+
+# бенчмарк не должен упираться в лимитер квоты и писать статистику латентностей в рабочий STATE_DIR
+os.environ.setdefault("SHEETS_READS_PER_MINUTE", "100000000")
+os.environ.setdefault("SHEETS_WRITES_PER_MINUTE", "100000000")
+os.environ["SYNC_STATE_DIR"] = tempfile.mkdtemp(prefix="bench_state_")
+os.environ.setdefault("GCP_SERVICE_ACCOUNT", "{}")  # ISM-update читает его при импорте
+
+import pandas as pd
+
+from sheets_io import write_dataframe, parse_values_stream, STREAM_CHUNK
+from sync_jobs import load_script
+from sync_parallel import hash_rows, duplicated
+from sync_strategies import batch_get_columns, normalize_frame
+
+# —————————————————————————————
+DEFAULT_SIZES = [10_000, 100_000, 500_000, 2_000_000]
+SEED = 42
+
+FETCH_COLUMNS_SCRIPTS = {
+    "update_groups.py": 5,
+    "update_groups_NEW.py": 4,
+    "update_IND.py": 1,
+    "update_tutors.py": 7,
+    "rates-update.py": 6,
+    "0-students_disbanding.py": 10,
+    "QA-update.py": 5,
+}
+ISM_SOURCE_COLS = 30
+# —————————————————————————————
+
+
+class FakeWorksheet:
+    """Подставной лист: отдаёт заранее сгенерированные данные без сети."""
+
+    spreadsheet_id = "bench"
+    client = None
+    title = "bench"
+    id = 0
+
+    def __init__(self, columns=None):
+        self.columns = columns
+        self.row_count = 0
+        self.col_count = 0
+        self.updated = 0
+
+    def batch_get(self, ranges):
+        return self.columns[:len(ranges)]
+
+    def resize(self, rows=None, cols=None):
+        self.row_count = rows or self.row_count
+        self.col_count = cols or self.col_count
+
+    def update_cells(self, cells, value_input_option=None):
+        self.updated = len(cells)
+
+    @property
+    def spreadsheet(self):
+        return self
+
+    def values_update(self, range_name, params=None, body=None):
+        self.updated = len(body["values"])
+
+
+def _cell(rng, kind, i):
+    if kind == 0:
+        return str(100000 + i)
+    if kind == 1:
+        return f"  Name {rng.randrange(5000)} " if rng.random() < 0.1 else f"Name {rng.randrange(5000)}"
+    if kind == 2:
+        return f"2024-{rng.randrange(1, 13):02d}-{rng.randrange(1, 29):02d}"
+    return str(rng.randrange(1, 11))
+
+
+def make_batch(rows, ncols, seed=SEED):
+    """Ответ batch_get: список колонок, каждая — список строк вида [value] или [] для пустых."""
+    rng = random.Random(seed)
+    batch = []
+    for c in range(ncols):
+        col = [[f"Header {c}"]]
+        # хвост части колонок пустой, как у реальных листов — batch_get его не возвращает
+        length = rows if c % 3 else rows - rows // 50
+        for i in range(length):
+            col.append([] if rng.random() < 0.02 else [_cell(rng, c % 4, i)])
+        batch.append(col)
+    return batch
+
+
+def make_values(rows, ncols, seed=SEED):
+    """Ответ values.get: строки разной длины (пустой хвост строки API обрезает)."""
+    rng = random.Random(seed)
+    values = [[f"Header {c}" for c in range(ncols)]]
+    for i in range(rows):
+        width = ncols if rng.random() < 0.7 else rng.randrange(1, ncols)
+        values.append([_cell(rng, c % 4, i) for c in range(width)])
+    return values
+
+
+def make_qa_frames(rows, seed=SEED):
+    """Три источника QA по rows/3 строк с ~20% пересечений между архивами."""
+    rng = random.Random(seed)
+    per = max(1, rows // 3)
+    cols = ["Date", "Tutor", "Score", "Comment", "Group"]
+
+    def frame(offset):
+        data = [[f" 2024-01-{(i % 28) + 1:02d}", f"tutor{(i + offset) % 3000} ",
+                 str(rng.randrange(1, 11)), f"comment {(i + offset) % 7000}", f"G{(i + offset) % 900}"]
+                for i in range(per)]
+        return pd.DataFrame(data, columns=cols)
+
+    return frame(0), frame(per // 5), frame(per // 2)
+
+
+def qa_dedupe(qa, frames, budget=None):
+    """Путь main() QA-update: источники по одному в SpillDedupe, результат — кусками (не склеиваем)."""
+    rows = 0
+    with qa.new_dedupe(frames[0]) as dedupe:
+        if budget is not None:
+            dedupe.budget = budget
+        for df, label in zip(frames, ("OLD", "ARCH", "GRAD")):
+            qa.add_source(dedupe, df, label)
+        for chunk in dedupe.chunks():
+            rows += len(chunk)
+    return rows
+
+
+def values_to_frame(text):
+    """Старый путь чтения ISM: весь ответ в list-of-lists, выравнивание строк, DataFrame."""
+    values = json.loads(text)["values"]
+    max_len = max(len(r) for r in values)
+    values = [r + [""] * (max_len - len(r)) for r in values]
+    return pd.DataFrame(values[1:], columns=values[0])
+
+
+def measure(setup, fn, repeat):
+    """Лучшее время из repeat прогонов + пиковая память отдельным прогоном под tracemalloc."""
+    best = float("inf")
+    for _ in range(repeat):
+        args = setup()
+        gc.collect()
+        t0 = time.perf_counter()
+        fn(*args)
+        best = min(best, time.perf_counter() - t0)
+        del args
+
+    args = setup()
+    gc.collect()
+    tracemalloc.start()
+    fn(*args)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return best, peak
+
+
+def stages(rows):
+    """
+    Генератор (имя стадии, setup, fn) для заданного числа строк — данные
+    строятся перед каждой стадией, чтобы на 2M строк не держать всё сразу.
+    """
+    for script, ncols in FETCH_COLUMNS_SCRIPTS.items():
+        batch = make_batch(rows, ncols)
+        ws = FakeWorksheet(columns=batch)
+        cols_idx = list(range(ncols))
+        yield (f"batch_get_columns[{script}]", lambda ws=ws: (ws,),
+               lambda ws, c=cols_idx: normalize_frame(batch_get_columns(ws, c)))
+
+    # ответ values.get целиком (как раньше через get_all_values) против потокового разбора в колонки
+    ism = load_script("ISM-update.py")
+    text = json.dumps({"range": "bench!A1:AD", "majorDimension": "ROWS",
+                       "values": make_values(rows, ISM_SOURCE_COLS)})
+    chunks = [text[i:i + STREAM_CHUNK] for i in range(0, len(text), STREAM_CHUNK)]
+    yield ("json.loads+DataFrame[ISM-update.py]", lambda: (text,), values_to_frame)
+    yield ("parse_values_stream[ISM-update.py]", lambda: (iter(chunks),),
+           lambda c, m=ism: parse_values_stream(c, m.SRC_COLS, rows))
+    del text, chunks
+
+    qa = load_script("QA-update.py")
+    frames = make_qa_frames(rows)
+    yield ("spill_dedupe[QA-update.py, in memory]", lambda: (tuple(f.copy() for f in frames),),
+           lambda f: qa_dedupe(qa, f))
+    yield ("spill_dedupe[QA-update.py, spilled]", lambda: (tuple(f.copy() for f in frames),),
+           lambda f: qa_dedupe(qa, f, budget=1))
+
+    df = pd.concat(frames, ignore_index=True)
+    yield ("hash_rows", lambda: (df,), hash_rows)
+    yield ("duplicated", lambda: (df,), duplicated)
+
+    from gspread_dataframe import set_with_dataframe
+    yield ("set_with_dataframe", lambda: (FakeWorksheet(),),
+           lambda ws: set_with_dataframe(ws, df, row=2, col=1, include_index=False,
+                                         include_column_header=False))
+    yield ("write_dataframe", lambda: (FakeWorksheet(),),
+           lambda ws: write_dataframe(ws, df, row=2, col=1, include_column_header=False))
+
+
+def run(sizes, repeat, only=None):
+    results = {}
+    for rows in sizes:
+        for name, setup, fn in stages(rows):
+            if only and only not in name:
+                continue
+            seconds, peak = measure(setup, fn, repeat)
+            results.setdefault(name, {})[str(rows)] = {"seconds": round(seconds, 4),
+                                                       "peak_mb": round(peak / 2**20, 1)}
+            print(f"{name:<45} {rows:>9,} rows  {seconds:>9.3f}s  {peak / 2**20:>9.1f} MB peak", flush=True)
+    return results
+
+
+def compare(results, baseline, threshold):
+    """Регрессия — если время или пик памяти хуже baseline более чем в threshold раз."""
+    regressions = []
+    for name, by_rows in results.items():
+        for rows, cur in by_rows.items():
+            base = baseline.get(name, {}).get(rows)
+            if not base:
+                continue
+            for metric in ("seconds", "peak_mb"):
+                if base[metric] > 0 and cur[metric] > base[metric] * threshold:
+                    regressions.append(f"{name} @ {rows} rows: {metric} {base[metric]} → {cur[metric]}")
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="CPU-side micro-benchmarks for the sync transforms")
+    parser.add_argument("--sizes", default=",".join(str(s) for s in DEFAULT_SIZES),
+                        help="comma-separated row counts")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--only", help="run only stages whose name contains this substring")
+    parser.add_argument("--save", help="write results as JSON (e.g. a new baseline)")
+    parser.add_argument("--compare", help="baseline JSON to check for regressions")
+    parser.add_argument("--threshold", type=float, default=1.3,
+                        help="allowed slowdown / memory growth factor vs baseline")
+    args = parser.parse_args(argv)
+
+    logging.disable(logging.INFO)
+    sizes = [int(s) for s in args.sizes.split(",") if s]
+    results = run(sizes, args.repeat, args.only)
+
+    if args.save:
+        with open(args.save, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.threshold)
+        for r in regressions:
+            print(f"❌ regression: {r}")
+        if regressions:
+            return 1
+        print(f"✔ No regressions vs {args.compare} (threshold ×{args.threshold})")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -2,16 +2,22 @@
 import os
 import json
 import logging
-import time
 
-import pandas as pd
 import gspread
 from oauth2client.service_account import ServiceAccountCredentials
-from gspread_dataframe import set_with_dataframe
-from gspread.exceptions import APIError, WorksheetNotFound
-from gspread.utils import rowcol_to_a1
+
+from sync_cdc import capture_changes
+from sync_versions import source_versions, sources_unchanged, mark_synced, claim_destination
+from sync_filters import filtered_read
+from sync_strategies import read_columns
+from sync_profile import profile_job
+from sheets_io import (
+    Deadline, api_retry_open, api_retry_worksheet, destination_lock, write_call, write_dataframe,
+)
 
 # —————————————————————————————
+JOB_NAME = "rates-update"
+
 SOURCE_SS_ID      = "1xqGCXsebSmYL4bqAwvTmD9lOentI45CTMxhea-ZDFls"
 SOURCE_SHEET_NAME = "Tutors"
 
@@ -22,57 +28,6 @@ DEST_SHEET_NAME   = "rates"
 logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
 
 
-def api_retry_open(client, key, max_attempts=5, backoff=1.0):
-    for i in range(1, max_attempts + 1):
-        try:
-            return client.open_by_key(key)
-        except APIError as e:
-            code = getattr(e.response, "status_code", None) or getattr(e.response, "status", None)
-            if code and 500 <= int(code) < 600 and i < max_attempts:
-                time.sleep(backoff); backoff *= 2
-                continue
-            raise
-
-def api_retry_worksheet(sh, title, max_attempts=5, backoff=1.0):
-    for i in range(1, max_attempts + 1):
-        try:
-            return sh.worksheet(title)
-        except APIError as e:
-            code = getattr(e.response, "status_code", None) or getattr(e.response, "status", None)
-            if code and 500 <= int(code) < 600 and i < max_attempts:
-                time.sleep(backoff); backoff *= 2
-                continue
-            raise
-        except WorksheetNotFound:
-            raise
-
-def fetch_columns(ws, cols_idx, max_attempts=5, backoff=1.0):
-    """
-    batch_get только нужных колонок (по индексам cols_idx).
-    cols_idx — список 0-based индексов (например [0,1,22,...])
-    """
-    for attempt in range(1, max_attempts+1):
-        try:
-            # Собираем диапазоны вида "A1:A", "B1:B", "W1:W" и т.п.
-            ranges = []
-            for idx in cols_idx:
-                a1 = rowcol_to_a1(1, idx+1)            # "A1", "B1", "W1"... 
-                letter = ''.join(filter(str.isalpha, a1))  # "A", "B", "W"...
-                ranges.append(f"{letter}1:{letter}")
-            batch = ws.batch_get(ranges)
-            # Преобразуем: [[['H1'],['r1'],...], ...] → колонки
-            cols = []
-            for col in batch:
-                cols.append([row[0] if row else "" for row in col])
-            headers = [col[0] for col in cols]
-            data    = list(zip(*(col[1:] for col in cols)))
-            return pd.DataFrame(data, columns=headers)
-        except Exception as e:
-            if attempt < max_attempts:
-                time.sleep(backoff); backoff *= 2
-                continue
-            raise
-
 def main():
     # 1) Авторизация
     scope   = ["https://spreadsheets.google.com/feeds","https://www.googleapis.com/auth/drive"]
@@ -81,22 +36,35 @@ def main():
               )
     client  = gspread.authorize(creds)
     logging.info("✔ Authenticated")
+    deadline = Deadline.from_env(JOB_NAME)
+
+    # Источники не менялись с прошлой успешной синхронизации — не читаем и не пишем
+    src_versions = source_versions(client, JOB_NAME, deadline)
+    if sources_unchanged(JOB_NAME, src_versions):
+        logging.info("✔ Sources unchanged since last sync — skipping fetch and write")
+        return
 
     # 2) Открываем исходный лист
-    sh_src = api_retry_open(client, SOURCE_SS_ID)
-    ws_src = api_retry_worksheet(sh_src, SOURCE_SHEET_NAME)
+    sh_src = api_retry_open(client, SOURCE_SS_ID, deadline)
+    ws_src = api_retry_worksheet(sh_src, SOURCE_SHEET_NAME, deadline)
 
     # 3) Тянем только нужные колонки
     cols_to_take = [0, 1, 22, 23, 24, 18]
-    df = fetch_columns(ws_src, cols_to_take)
+    df = filtered_read(JOB_NAME, 0, ws_src, lambda: read_columns(ws_src, cols_to_take, deadline), deadline)
     logging.info(f"→ Fetched columns, shape={df.shape}")
 
     # 4) Запись в целевой лист
-    sh_dst = api_retry_open(client, DEST_SS_ID)
-    ws_dst = api_retry_worksheet(sh_dst, DEST_SHEET_NAME)
-    ws_dst.clear()
-    set_with_dataframe(ws_dst, df)
+    sh_dst = api_retry_open(client, DEST_SS_ID, deadline, write=True)
+    ws_dst = api_retry_worksheet(sh_dst, DEST_SHEET_NAME, deadline)
+    with destination_lock(DEST_SS_ID, DEST_SHEET_NAME):
+        write_deadline = deadline.write_phase()   # до очистки: хватит ли бюджета, дальше — свой
+        claim_destination(JOB_NAME)   # с этого момента лист наш, пока не mark_synced
+        write_call(ws_dst.clear, write_deadline, ws_dst.client)
+        write_dataframe(ws_dst, df, deadline=write_deadline)
+    capture_changes(JOB_NAME, df)
+    mark_synced(JOB_NAME, src_versions)
     logging.info(f"✔ Written to '{DEST_SHEET_NAME}' — {df.shape[0]} rows")
 
 if __name__ == "__main__":
-    main()
+    with profile_job(JOB_NAME):
+        main()
@@ -0,0 +1,977 @@
+#!/usr/bin/env python3
+"""
+Общий слой доступа к Google Sheets для всех update-скриптов:
+ретраи, дедлайн на весь джоб, общий лимитер квоты и hedged-чтения.
+
+GCP_SERVICE_ACCOUNTS (JSON-список ключей) включает пул сервисных аккаунтов:
+у каждого свой лимитер квоты, open_by_key раскладывается по аккаунтам
+(least_loaded или consistent hash по ID таблицы) и при 429 / нет доступа
+уходит на следующий аккаунт.
+"""
+import os
+import re
+import fcntl
+import atexit
+import codecs
+import hashlib
+import json
+import logging
+import time
+import threading
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from urllib.parse import quote
+
+import numpy as np
+import pandas as pd
+import gspread
+from oauth2client.service_account import ServiceAccountCredentials
+from gspread.exceptions import APIError, WorksheetNotFound, SpreadsheetNotFound
+from gspread.utils import rowcol_to_a1, absolute_range_name
+from requests.exceptions import RequestException
+
+# —————————————————————————————
+STATE_DIR = os.environ.get("SYNC_STATE_DIR", ".sync_state")
+LOCKS_DIR = os.path.join(STATE_DIR, "locks")
+LOCK_WAIT_SECONDS = float(os.environ.get("SYNC_LOCK_WAIT_SECONDS", "1800"))
+
+JOB_DEADLINE_SECONDS = float(os.environ.get("JOB_DEADLINE_SECONDS", "900"))
+CALL_TIMEOUT_CAP     = float(os.environ.get("SHEETS_CALL_TIMEOUT", "120"))
+WRITE_RESERVE_SECONDS = float(os.environ.get("JOB_WRITE_RESERVE_SECONDS", "60"))   # меньше — лист не очищаем
+WRITE_PHASE_SECONDS  = float(os.environ.get("JOB_WRITE_PHASE_SECONDS", "600"))    # свой бюджет очистки + записи
+WRITE_CALL_TIMEOUT   = float(os.environ.get("SHEETS_WRITE_CALL_TIMEOUT", "300"))
+READ_ATTEMPTS        = 5          # попыток на одно чтение (429 / 5xx / сеть), бэкофф удваивается
+
+READS_PER_MINUTE  = int(os.environ.get("SHEETS_READS_PER_MINUTE", "60"))
+WRITES_PER_MINUTE = int(os.environ.get("SHEETS_WRITES_PER_MINUTE", "60"))
+
+SCOPE = ["https://spreadsheets.google.com/feeds", "https://www.googleapis.com/auth/drive"]
+DRIVE_FILES = "https://www.googleapis.com/drive/v3/files/{}"
+VALUES_URL  = "https://sheets.googleapis.com/v4/spreadsheets/{}/values/{}"
+
+STREAM_CHUNK      = 1 << 16
+PREALLOC_MAX_ROWS = 2_000_000     # больше заранее не выделяем, дальше буферы растут append'ом
+
+ACCOUNT_STRATEGY  = os.environ.get("SHEETS_ACCOUNT_STRATEGY", "least_loaded")   # least_loaded | hash
+THROTTLE_COOLDOWN = float(os.environ.get("SHEETS_THROTTLE_COOLDOWN", "60"))      # сек после 429
+
+HEDGE_READS         = os.environ.get("SHEETS_HEDGE_READS", "0") == "1"
+HEDGE_DEFAULT_DELAY = 5.0   # пока нет статистики по операции
+HEDGE_MIN_DELAY     = 0.5
+HEDGE_MIN_SAMPLES   = 20
+HEDGE_MIN_LATENCY   = 1.0   # сек p95 — быстрее хеджировать нет смысла, вызов идёт в том же потоке
+LATENCY_WINDOW      = 200
+
+GRID_HEADROOM   = int(os.environ.get("SHEETS_GRID_HEADROOM", "500"))   # пустых строк под данными при compact
+CELL_LIMIT      = 10_000_000      # лимит ячеек на таблицу (все вкладки)
+CELL_WARN_SHARE = 0.8
+
+SHEETS_EPOCH = pd.Timestamp("1899-12-30")
+# строки, которые USER_ENTERED превратил бы во что-то другое (числа, даты, формулы, TRUE/FALSE, '…);
+# даты текстом без цифры в начале ("Mar 12", "March 12, 2024", "Tue, Mar 12") — тоже, иначе RAW оставит их строкой
+NEEDS_PARSING_RE = (r"^\s*(?:[=+\-'$.(]|\d|true\s*$|false\s*$"
+                    r"|(?:(?:mon|tue|wed|thu|fri|sat|sun)[a-z]*\.?,?\s+)?"
+                    r"(?:jan|feb|mar|apr|may|jun|jul|aug|sep|oct|nov|dec)[a-z]*\.?[\s,\-/]*\d)")
+# —————————————————————————————
+
+
+def authorize():
+    sa_json = json.loads(os.environ["GCP_SERVICE_ACCOUNT"])
+    creds = ServiceAccountCredentials.from_json_keyfile_dict(sa_json, SCOPE)
+    return gspread.authorize(creds)
+
+
+class DeadlineExceeded(TimeoutError):
+    pass
+
+
+class Deadline:
+    """
+    Бюджет времени на весь джоб. Передаётся вниз в каждый вызов API:
+    таймаут отдельного запроса никогда не превышает остаток бюджета.
+    """
+
+    def __init__(self, seconds, name="job", call_cap=CALL_TIMEOUT_CAP):
+        self.name = name
+        self.seconds = seconds
+        self.call_cap = call_cap
+        self.expires_at = time.monotonic() + seconds
+
+    @classmethod
+    def from_env(cls, name="job"):
+        return cls(JOB_DEADLINE_SECONDS, name)
+
+    def remaining(self):
+        return self.expires_at - time.monotonic()
+
+    def check(self, what=""):
+        if self.remaining() <= 0:
+            raise DeadlineExceeded(f"{self.name}: deadline of {self.seconds:.0f}s exceeded {what}".rstrip())
+
+    def timeout(self, cap=None):
+        self.check()
+        return max(0.1, min(self.call_cap if cap is None else cap, self.remaining()))
+
+    def write_phase(self):
+        """
+        Вызывать перед деструктивной очисткой целевого листа. Если от бюджета осталось
+        меньше WRITE_RESERVE_SECONDS — падаем до очистки (лист остаётся прежним).
+        Иначе очистка и запись получают свой бюджет: начатую запись дедлайн джоба
+        не обрывает, и отдельный вызов может идти до SHEETS_WRITE_CALL_TIMEOUT.
+        """
+        if self.remaining() < WRITE_RESERVE_SECONDS:
+            raise DeadlineExceeded(f"{self.name}: only {max(0.0, self.remaining()):.0f}s left, "
+                                   f"not clearing the destination (need {WRITE_RESERVE_SECONDS:.0f}s)")
+        return Deadline(WRITE_PHASE_SECONDS, f"{self.name}:write", call_cap=WRITE_CALL_TIMEOUT)
+
+    def sleep(self, seconds, what="before retry"):
+        # не спим, если после сна на запрос уже не останется времени
+        if seconds >= self.remaining():
+            raise DeadlineExceeded(f"{self.name}: no budget left to wait {seconds:.1f}s {what}")
+        time.sleep(seconds)
+
+
+def backoff_sleep(deadline, seconds):
+    if deadline is not None:
+        deadline.sleep(seconds)
+    else:
+        time.sleep(seconds)
+
+
+def apply_timeout(client, deadline):
+    """
+    Выставляем таймаут HTTP-клиента gspread по остатку дедлайна.
+    В разных версиях gspread set_timeout живёт на Client или на http_client.
+    """
+    if deadline is None or client is None:
+        return
+    timeout = deadline.timeout()
+    for target in (client, getattr(client, "http_client", None)):
+        setter = getattr(target, "set_timeout", None)
+        if setter is not None:
+            setter(timeout)
+            return
+
+
+class QuotaLimiter:
+    """Token bucket на запросы в минуту, общий для всех потоков процесса."""
+
+    def __init__(self, per_minute):
+        self.capacity = max(1, per_minute)
+        self.tokens = float(self.capacity)
+        self.rate = self.capacity / 60.0
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def headroom(self):
+        """Доля свободных токенов (0..1) — для выбора наименее загруженного аккаунта."""
+        with self.lock:
+            self._refill()
+            return self.tokens / self.capacity
+
+    def try_acquire(self):
+        with self.lock:
+            self._refill()
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return True
+            return False
+
+    def acquire(self, deadline=None):
+        while True:
+            with self.lock:
+                self._refill()
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait_s = (1 - self.tokens) / self.rate
+            backoff_sleep(deadline, wait_s)
+
+
+READ_LIMITER  = QuotaLimiter(READS_PER_MINUTE)
+WRITE_LIMITER = QuotaLimiter(WRITES_PER_MINUTE)
+
+
+def http_client(client):
+    # gspread 6: client.http_client.request, gspread 5: client.request
+    return getattr(client, "http_client", client)
+
+
+class Account:
+    """Сервисный аккаунт пула: свой клиент, свои лимитеры, доступ по таблицам."""
+
+    def __init__(self, email, client, read=None, write=None):
+        self.email = email
+        self.client = client
+        self.read = read or QuotaLimiter(READS_PER_MINUTE)
+        self.write = write or QuotaLimiter(WRITES_PER_MINUTE)
+        self.cooldown_until = 0.0
+        self.access = {}          # ss_id → "edit" | "read" | "none"; нет ключа — не проверяли
+
+    @property
+    def cooling(self):
+        return time.monotonic() < self.cooldown_until
+
+
+class AccountPool:
+    """
+    Пул сервисных аккаунтов. Квота Sheets считается на принципала, поэтому
+    с N аккаунтами пропускная способность чтения растёт примерно в N раз.
+    """
+
+    def __init__(self, accounts, strategy=ACCOUNT_STRATEGY):
+        self.accounts = accounts
+        self.strategy = strategy
+        self._by_client = {}
+        self.lock = threading.Lock()
+        for account in accounts:
+            self._bind(account.client, account)
+
+    def _bind(self, client, account):
+        self._by_client[id(client)] = account
+        self._by_client[id(http_client(client))] = account
+
+    def account_for(self, client):
+        return self._by_client.get(id(client)) if client is not None else None
+
+    def adopt(self, client):
+        """Клиент, созданный скриптом сам, считаем по квоте того аккаунта пула, чей это ключ."""
+        if client is None or self.account_for(client):
+            return
+        email = getattr(getattr(http_client(client), "auth", None), "service_account_email", None)
+        for account in self.accounts:
+            if account.email == email:
+                with self.lock:
+                    self._bind(client, account)
+                return
+
+    def ranked(self, key, need_edit=False):
+        """
+        Аккаунты в порядке попыток для таблицы key: без доступа — отбрасываем, после 429 — в конец.
+        least_loaded при равной загрузке (на старте у всех 100%) решает rendezvous-хэш
+        таблицы и потока (runner называет поток именем джоба) — параллельные джобы
+        расходятся по разным аккаунтам, а не начинают все с первого.
+        """
+        allowed = ("edit", None) if need_edit else ("edit", "read", None)
+        candidates = [a for a in self.accounts if a.access.get(key) in allowed]
+        if self.strategy == "hash":
+            # rendezvous hashing: таблица стабильно попадает на один аккаунт, пока он доступен
+            candidates.sort(key=lambda a: hashlib.sha1(f"{key}/{a.email}".encode()).hexdigest())
+        else:
+            caller = threading.current_thread().name
+            candidates.sort(key=lambda a: (-round(a.read.headroom(), 2),
+                                           hashlib.sha1(f"{key}/{caller}/{a.email}".encode()).hexdigest()))
+        return sorted(candidates, key=lambda a: a.cooling)
+
+    def throttled(self, account):
+        account.cooldown_until = time.monotonic() + THROTTLE_COOLDOWN
+        logging.warning(f"⚠ 429 for {account.email}, moving new work off it for {THROTTLE_COOLDOWN:.0f}s")
+
+    def check_access(self, keys, edit_keys=(), deadline=None):
+        """
+        Проверка доступа каждого аккаунта к таблицам (Drive files.get capabilities)
+        до первого чтения — как подсказка SpreadsheetNotFound в 0-students, но сразу
+        по всем аккаунтам. Возвращает список проблемных таблиц.
+        """
+        problems = []
+        for key in dict.fromkeys(keys):
+            for account in self.accounts:
+                if key in account.access:
+                    continue
+                try:
+                    meta = read_call(lambda: http_client(account.client).request(
+                        "get", DRIVE_FILES.format(key),
+                        params={"fields": "id,capabilities/canEdit", "supportsAllDrives": True},
+                    ).json(), "drive_access", deadline, account.client, hedge=False, quota=False)
+                    account.access[key] = "edit" if meta.get("capabilities", {}).get("canEdit") else "read"
+                except APIError as e:
+                    if api_error_code(e) in (403, 404):
+                        account.access[key] = "none"
+                    else:
+                        logging.warning(f"Access check {key} as {account.email} failed: {e}")
+            need = "edit" if key in edit_keys else "read"
+            ok = [a for a in self.accounts if a.access.get(key) in (("edit",) if need == "edit" else ("edit", "read"))]
+            if not ok and all(key in a.access for a in self.accounts):
+                problems.append(key)
+                emails = ", ".join(a.email for a in self.accounts)
+                logging.error(f"❌ No account in the pool can {need} {key}. "
+                              f"Дай доступ{' (Editor)' if need == 'edit' else ''} одному из: {emails}")
+        return problems
+
+    def summary(self):
+        return ", ".join(f"{a.email}: read {a.read.headroom():.0%} write {a.write.headroom():.0%}"
+                         f"{' (cooling)' if a.cooling else ''}" for a in self.accounts)
+
+
+def _service_account_keys():
+    keys = []
+    for var in ("GCP_SERVICE_ACCOUNT", "GCP_SERVICE_ACCOUNTS"):
+        raw = os.environ.get(var, "").strip()
+        if raw:
+            value = json.loads(raw)
+            keys.extend(value if isinstance(value, list) else [value])
+    seen, unique = set(), []
+    for key in keys:
+        email = key.get("client_email")
+        if email and email not in seen:
+            seen.add(email)
+            unique.append(key)
+    return unique
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_pool():
+    """Пул аккаунтов или None, если настроен один аккаунт (тогда всё как раньше)."""
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            keys = _service_account_keys()
+            if len(keys) < 2:
+                _pool = False
+            else:
+                accounts = []
+                for i, key in enumerate(keys):
+                    client = gspread.authorize(ServiceAccountCredentials.from_json_keyfile_dict(key, SCOPE))
+                    # первый аккаунт — тот же принципал, что и у клиентов скриптов: общие лимитеры
+                    shared = (READ_LIMITER, WRITE_LIMITER) if i == 0 else (None, None)
+                    accounts.append(Account(key["client_email"], client, *shared))
+                _pool = AccountPool(accounts)
+                logging.info(f"✔ Service-account pool: {len(accounts)} accounts, strategy={_pool.strategy}")
+        return _pool or None
+
+
+def _limiter(client, kind):
+    pool = get_pool()
+    account = pool.account_for(client) if pool else None
+    if account is None:
+        return READ_LIMITER if kind == "read" else WRITE_LIMITER
+    return account.read if kind == "read" else account.write
+
+
+def _note_error(client, e):
+    pool = get_pool()
+    account = pool.account_for(client) if pool else None
+    if account is not None and isinstance(e, APIError) and api_error_code(e) == 429:
+        pool.throttled(account)
+
+
+class LatencyStats:
+    """
+    Скользящее окно латентностей по операциям (например "batch_get:<ss_id>").
+    Сохраняется в STATE_DIR между запусками, чтобы p95 был известен с первого вызова.
+    """
+
+    def __init__(self, path=None):
+        self.path = path or os.path.join(STATE_DIR, "latency.json")
+        self.samples = {}
+        self.lock = threading.Lock()
+        try:
+            with open(self.path, encoding="utf-8") as f:
+                self.samples = json.load(f)
+        except (OSError, ValueError):
+            self.samples = {}
+
+    def record(self, op, seconds):
+        with self.lock:
+            window = self.samples.setdefault(op, [])
+            window.append(round(seconds, 3))
+            del window[:-LATENCY_WINDOW]
+
+    def percentile(self, op, q):
+        with self.lock:
+            window = sorted(self.samples.get(op, []))
+        if len(window) < HEDGE_MIN_SAMPLES:
+            return None
+        return window[min(len(window) - 1, int(q * len(window)))]
+
+    def save(self):
+        try:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            with self.lock, open(self.path, "w", encoding="utf-8") as f:
+                json.dump(self.samples, f)
+        except OSError as e:
+            logging.warning(f"Could not save latency stats: {e}")
+
+
+LATENCY = LatencyStats()
+atexit.register(LATENCY.save)
+
+_hedge_pool = ThreadPoolExecutor(max_workers=8, thread_name_prefix="hedge")
+
+
+def hedge_delay(op):
+    p95 = LATENCY.percentile(op, 0.95)
+    return HEDGE_DEFAULT_DELAY if p95 is None else max(HEDGE_MIN_DELAY, p95)
+
+
+def _timed(fn, op):
+    started = time.monotonic()
+    result = fn()
+    LATENCY.record(op, time.monotonic() - started)
+    return result
+
+
+def worth_hedging(op):
+    """Хеджируем только операции с известным и заметным p95 (≥ HEDGE_MIN_LATENCY)."""
+    p95 = LATENCY.percentile(op, 0.95)
+    return p95 is not None and p95 >= HEDGE_MIN_LATENCY
+
+
+def read_call(fn, op, deadline=None, client=None, hedge=None, quota=True):
+    """
+    Идемпотентное чтение с дедлайном. Если включён hedging и операция обычно
+    медленная (worth_hedging), через p95 задержку отправляем дубликат (только
+    если лимитер квоты даёт токен сразу) и берём первый успешный ответ; иначе
+    вызов идёт в том же потоке, ограниченный HTTP-таймаутом по остатку дедлайна.
+    quota=False — для запросов не к Sheets API (Drive).
+    """
+    hedge = HEDGE_READS if hedge is None else hedge
+    limiter = _limiter(client, "read")
+    if quota:
+        limiter.acquire(deadline)
+    apply_timeout(client, deadline)
+    if deadline is None or not hedge or not worth_hedging(op):
+        try:
+            return _timed(fn, op)
+        except Exception as e:
+            _note_error(client, e)
+            raise
+
+    futures = [_hedge_pool.submit(_timed, fn, op)]
+    done, _ = wait(futures, timeout=min(hedge_delay(op), deadline.remaining()))
+    if not done and deadline.remaining() > 0:
+        if not quota or limiter.try_acquire():
+            logging.info(f"{op}: no answer after {hedge_delay(op):.1f}s, sending hedged request")
+            futures.append(_hedge_pool.submit(_timed, fn, op))
+        else:
+            logging.info(f"{op}: slow, but quota limiter has no headroom for a hedge")
+
+    error = None
+    pending = set(futures)
+    while pending:
+        done, pending = wait(pending, timeout=max(0, deadline.remaining()), return_when=FIRST_COMPLETED)
+        if not done:
+            break
+        for fut in done:
+            if fut.exception() is None:
+                return fut.result()
+            error = fut.exception()
+    if error is not None:
+        _note_error(client, error)
+        raise error
+    raise DeadlineExceeded(f"{deadline.name}: {op} did not answer within the deadline")
+
+
+def ws_ss_id(ws):
+    # gspread 6: ws.spreadsheet_id, gspread 5: ws.spreadsheet.id
+    return getattr(ws, "spreadsheet_id", None) or ws.spreadsheet.id
+
+
+def api_error_code(e):
+    return getattr(e.response, "status_code", None) or getattr(e.response, "status", None)
+
+
+def is_retryable(e):
+    """429 / 5xx / сетевые сбои — стоит повторить; 400, 403, 404 и прочее — нет."""
+    if isinstance(e, APIError):
+        code = api_error_code(e)
+        return code is None or int(code) == 429 or int(code) >= 500
+    if isinstance(e, RequestException):
+        code = getattr(e.response, "status_code", None)
+        return code is None or code == 429 or code >= 500
+    return False
+
+
+def failover_worksheet(ws, deadline=None):
+    """
+    Перевести чтения ws на другой аккаунт пула с доступом к таблице (не тот же и не
+    остывающий после 429). False — пула нет или переключаться некуда. fn в retry_read
+    должны брать ws.client при каждом вызове, тогда следующая попытка уйдёт уже им.
+    """
+    pool = get_pool()
+    if pool is None:
+        return False
+    key = ws_ss_id(ws)
+    current = pool.account_for(ws.client)
+    pool.check_access([key], deadline=deadline)
+    for account in pool.ranked(key):
+        if account is current or account.cooling:
+            continue
+        client = http_client(account.client)
+        ws.client = client
+        spreadsheet = getattr(ws, "_spreadsheet", None)
+        if spreadsheet is not None:
+            spreadsheet.client = client
+        logging.warning(f"→ {key}: reads moved from {current.email if current else 'default account'} to {account.email}")
+        return True
+    return False
+
+
+def retry_read(fn, what, deadline=None, max_attempts=READ_ATTEMPTS, backoff=1.0, retry_on=(), ws=None):
+    """
+    fn() с ретраями is_retryable-ошибок (и retry_on) и экспоненциальным бэкоффом в пределах дедлайна.
+    С ws и пулом аккаунтов ретраибельная ошибка API сначала переводит чтения на другой
+    аккаунт (failover_worksheet) — тогда повтор сразу, без бэкоффа.
+    """
+    for i in range(1, max_attempts + 1):
+        try:
+            return fn()
+        except Exception as e:
+            if i == max_attempts or not (is_retryable(e) or isinstance(e, retry_on)):
+                raise
+            if ws is not None and is_retryable(e) and failover_worksheet(ws, deadline):
+                logging.warning(f"{what} failed ({e}), attempt {i}/{max_attempts}, retrying on another account")
+                continue
+            logging.warning(f"{what} failed ({e}), attempt {i}/{max_attempts}, retrying in {backoff:.1f}s")
+            backoff_sleep(deadline, backoff)
+            backoff *= 2
+
+
+def api_retry_open(client, key, deadline=None, max_attempts=5, backoff=1.0, write=False):
+    """
+    open_by_key с ретраями 5xx. С пулом аккаунтов таблица открывается тем
+    аккаунтом, что выбрал пул (write=True — только с правом Editor); при 429,
+    403 и SpreadsheetNotFound пробуем следующий аккаунт. Уже посреди джоба
+    чтения переезжают на другой аккаунт в retry_read (failover_worksheet).
+    """
+    pool = get_pool()
+    if pool is None:
+        return _open_with_retries(client, key, deadline, max_attempts, backoff)
+
+    pool.adopt(client)
+    pool.check_access([key], [key] if write else [], deadline)
+    error = None
+    for account in pool.ranked(key, need_edit=write):
+        try:
+            sh = _open_with_retries(account.client, key, deadline, max_attempts, backoff)
+            logging.info(f"→ {key} opened as {account.email}")
+            return sh
+        except SpreadsheetNotFound as e:
+            account.access[key] = "none"
+            error = e
+        except APIError as e:
+            code = api_error_code(e)
+            if code == 403:
+                account.access[key] = "none"
+            elif code != 429:   # 429 read_call уже отметил в пуле
+                raise
+            error = e
+        logging.warning(f"Failing over from {account.email} for {key}: {error}")
+    if error is None:
+        raise SpreadsheetNotFound(f"No account in the pool has access to {key}")
+    raise error
+
+
+def _open_with_retries(client, key, deadline, max_attempts, backoff):
+    for i in range(1, max_attempts + 1):
+        try:
+            logging.info(f"open_by_key({key}) attempt {i}/{max_attempts}")
+            return read_call(lambda: client.open_by_key(key), f"open:{key}", deadline, client, hedge=False)
+        except APIError as e:
+            code = api_error_code(e)
+            if code and 500 <= int(code) < 600 and i < max_attempts:
+                logging.warning(f"Received {code} — retrying in {backoff:.1f}s")
+                backoff_sleep(deadline, backoff)
+                backoff *= 2
+                continue
+            raise
+        except SpreadsheetNotFound:
+            # не ретраим 404 — сразу кидаем выше
+            raise
+
+
+def api_retry_worksheet(sh, title, deadline=None, max_attempts=5, backoff=1.0):
+    for i in range(1, max_attempts + 1):
+        try:
+            logging.info(f"worksheet('{title}') attempt {i}/{max_attempts}")
+            return read_call(lambda: sh.worksheet(title), f"worksheet:{sh.id}", deadline, sh.client, hedge=False)
+        except APIError as e:
+            code = api_error_code(e)
+            if code and 500 <= int(code) < 600 and i < max_attempts:
+                logging.warning(f"Received {code} — retrying in {backoff:.1f}s")
+                backoff_sleep(deadline, backoff)
+                backoff *= 2
+                continue
+            raise
+        except WorksheetNotFound:
+            logging.error(f"Worksheet '{title}' not found")
+            raise
+
+
+_VALUES_RE = re.compile(r'"values"\s*:\s*\[')
+_SEPARATOR_RE = re.compile(r"[\s,]*")
+
+
+def parse_values_stream(chunks, cols=None, expected_rows=0):
+    """
+    Потоковый разбор ответа values.get ({"range": …, "values": [[…], …]}) по
+    кускам текста: каждая строка декодируется отдельно (raw_decode) и сразу
+    раскладывается в буферы колонок cols; list-of-lists всего листа не строится.
+    cols=None — все колонки. Возвращает (header, columns, width), где width —
+    ширина самой длинной строки листа.
+    """
+    decoder = json.JSONDecoder()
+    n = min(max(expected_rows, 0), PREALLOC_MAX_ROWS)
+    columns = [] if cols is None else [[""] * n for _ in cols]
+    header, rows, width = None, 0, 0
+    buf, pos, started, done = "", 0, False, False
+
+    for chunk in chunks:
+        buf = buf[pos:] + chunk
+        pos = 0
+        if not started:
+            m = _VALUES_RE.search(buf)
+            if not m:
+                buf = buf[-64:]   # ключ мог разрезаться границей куска
+                continue
+            pos, started = m.end(), True
+        while True:
+            pos = _SEPARATOR_RE.match(buf, pos).end()
+            if pos >= len(buf):
+                break
+            if buf[pos] == "]":
+                done = True
+                break
+            try:
+                row, pos_next = decoder.raw_decode(buf, pos)
+            except json.JSONDecodeError:
+                break   # строка пришла не целиком — ждём следующий кусок
+            pos = pos_next
+            width = max(width, len(row))
+            if header is None:
+                header = row
+                continue
+            if cols is None:
+                while len(columns) < len(row):
+                    columns.append([""] * rows)
+                for j, column in enumerate(columns):
+                    column.append(row[j] if j < len(row) else "")
+            else:
+                for j, c in enumerate(cols):
+                    v = row[c] if c < len(row) else ""
+                    if rows < n:
+                        columns[j][rows] = v
+                    else:
+                        columns[j].append(v)
+            rows += 1
+        if done:
+            break
+
+    if started and not done:
+        raise ValueError("values response ended in the middle of the data")
+    header = header or []
+    for column in columns:
+        del column[rows:]
+    if cols is None:
+        while len(columns) < len(header):
+            columns.append([""] * rows)
+        header = header + [""] * (len(columns) - len(header))
+    else:
+        header = [header[c] if c < len(header) else "" for c in cols]
+    return header, columns, width
+
+
+def stream_columns(ws, cols=None, deadline=None, max_attempts=READ_ATTEMPTS, backoff=1.0):
+    """
+    Замена get_all_values для больших листов: ответ values.get качается с gzip,
+    разбирается потоково и сразу проецируется на колонки cols (0-based).
+    Пик памяти — порядка размера выбранных колонок, а не 2-3 копий всего листа.
+    В df.attrs["source_width"] — ширина листа (для проверок вида «нет колонки AC»).
+    """
+    session = http_client(ws.client).session
+    url = VALUES_URL.format(ws_ss_id(ws), quote(absolute_range_name(ws.title), safe=""))
+
+    def fetch():
+        resp = session.get(
+            url, params={"valueRenderOption": "FORMATTED_VALUE", "majorDimension": "ROWS"},
+            headers={"Accept-Encoding": "gzip", "User-Agent": "sheets-sync (gzip)"},
+            stream=True, timeout=deadline.timeout() if deadline is not None else CALL_TIMEOUT_CAP,
+        )
+        if not resp.ok:
+            raise APIError(resp)
+        try:
+            decoder = codecs.getincrementaldecoder("utf-8")()
+            chunks = (decoder.decode(b) for b in resp.iter_content(STREAM_CHUNK))
+            result = parse_values_stream(chunks, cols, ws.row_count - 1)
+        finally:
+            resp.close()
+        logging.info(f"values.get streamed ({resp.headers.get('Content-Encoding', 'identity')}), "
+                     f"{len(result[1][0]) if result[1] else 0} rows")
+        return result
+
+    # ValueError — оборванный поток (недокачанный JSON), его тоже повторяем
+    header, columns, width = retry_read(
+        lambda: read_call(fetch, f"get_all_values:{ws_ss_id(ws)}", deadline, ws.client),
+        "values.get stream", deadline, max_attempts, backoff, retry_on=(ValueError,), ws=ws)
+
+    df = pd.DataFrame(dict(enumerate(columns)), columns=range(len(header))).set_axis(header, axis=1)
+    df.attrs["source_width"] = width
+    return df
+
+
+_held_locks = {}          # путь lock-файла → [поток-владелец, глубина] — повторный вход того же потока
+_held_locks_lock = threading.Lock()
+
+
+@contextmanager
+def destination_lock(ss_id, sheet, wait=LOCK_WAIT_SECONDS):
+    """
+    Межпроцессный lock на целевой лист (flock, снимается даже при падении процесса).
+    Берут и runner вокруг джоба, и сам скрипт вокруг очистки и записи; повторно
+    в том же потоке — без второго flock (иначе процесс ждал бы сам себя).
+    flock действует только в пределах одного runner; между workflow запись
+    разводит общая concurrency-группа sheets-writers.
+    """
+    os.makedirs(LOCKS_DIR, exist_ok=True)
+    name = hashlib.sha1(f"{ss_id}/{sheet}".encode()).hexdigest()[:16]
+    path = os.path.join(LOCKS_DIR, f"{name}.lock")
+    me = threading.get_ident()
+    with _held_locks_lock:
+        held = _held_locks.get(path)
+        if held is not None and held[0] == me:
+            held[1] += 1
+        else:
+            held = None
+    if held is not None:
+        try:
+            yield
+        finally:
+            with _held_locks_lock:
+                held[1] -= 1
+        return
+
+    started = time.monotonic()
+    with open(path, "a+") as f:
+        while True:
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                break
+            except BlockingIOError:
+                if time.monotonic() - started > wait:
+                    raise TimeoutError(f"Destination '{sheet}' is locked by another process for {wait:.0f}s")
+                time.sleep(1.0)
+        f.seek(0)
+        f.truncate()
+        f.write(f"{os.getpid()} {ss_id}/{sheet}\n")
+        f.flush()
+        with _held_locks_lock:
+            _held_locks[path] = [me, 1]
+        try:
+            yield
+        finally:
+            with _held_locks_lock:
+                del _held_locks[path]
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def write_call(fn, deadline=None, client=None):
+    """Запись не хеджируем (не идемпотентна), но держим в дедлайне и квоте."""
+    _limiter(client, "write").acquire(deadline)
+    apply_timeout(client, deadline)
+    try:
+        return fn()
+    except Exception as e:
+        _note_error(client, e)
+        raise
+
+
+def _serial_date(values):
+    # RAW-дата = серийный номер Sheets (дни от 1899-12-30), формат колонки остаётся как был
+    return (values - SHEETS_EPOCH) / pd.Timedelta(days=1)
+
+
+def _column_values(s, kind=None):
+    """Одна колонка → object-массив для JSON: NaN/None → "", числа числами, даты по схеме."""
+    if kind == "number":
+        num = pd.to_numeric(s, errors="coerce")
+        s = num.astype(object).where(num.notna(), s)
+    elif kind == "date":
+        dt = pd.to_datetime(s, errors="coerce")
+        s = _serial_date(dt).astype(object).where(dt.notna(), s)
+    elif kind is None and pd.api.types.is_datetime64_any_dtype(s):
+        s = s.dt.strftime("%Y-%m-%d %H:%M:%S")
+    elif kind == "text":
+        s = s.astype(str).where(s.notna(), "")
+    return s.astype(object).where(s.notna(), "").to_numpy()
+
+
+def needs_parsing(df):
+    """Есть ли в текстовых колонках значения, которые Sheets распарсил бы при USER_ENTERED."""
+    for i in range(df.shape[1]):
+        s = df.iloc[:, i]
+        if pd.api.types.is_datetime64_any_dtype(s):
+            return True
+        if (s.dtype == object or pd.api.types.is_string_dtype(s)) and \
+                s.dropna().astype(str).str.match(NEEDS_PARSING_RE, case=False).any():
+            return True
+    return False
+
+
+def build_payload(df, include_column_header=True, schema=None):
+    """
+    DataFrame → (values, value_input_option) за один векторный проход по колонкам.
+    schema — {колонка: "text" | "number" | "date"}; если схема задана для всех
+    колонок или парсить нечего, шлём RAW и Sheets не разбирает каждую ячейку.
+    """
+    schema = schema or {}
+    columns = [_column_values(df.iloc[:, i], schema.get(name)) for i, name in enumerate(df.columns)]
+    if columns:
+        values = np.column_stack(columns).tolist() if len(df) else []
+    else:
+        values = [[] for _ in range(len(df))]
+    if include_column_header:
+        values.insert(0, [str(c) for c in df.columns])
+
+    untyped = df.iloc[:, [i for i, c in enumerate(df.columns) if c not in schema]]
+    option = "USER_ENTERED" if needs_parsing(untyped) else "RAW"
+    return values, option
+
+
+def cell_usage(spreadsheet_meta):
+    """{вкладка: rowCount × columnCount} по метаданным таблицы (ответ batchUpdate / fetch_sheet_metadata)."""
+    return {s["properties"]["title"]: s["properties"].get("gridProperties", {}).get("rowCount", 0)
+            * s["properties"].get("gridProperties", {}).get("columnCount", 0)
+            for s in spreadsheet_meta.get("sheets", [])}
+
+
+def log_cell_usage(spreadsheet_meta):
+    usage = cell_usage(spreadsheet_meta)
+    total = sum(usage.values())
+    title = spreadsheet_meta.get("properties", {}).get("title", spreadsheet_meta.get("spreadsheetId", "?"))
+    largest = ", ".join(f"{t} {n:,}" for t, n in sorted(usage.items(), key=lambda x: -x[1])[:3])
+    msg = f"Spreadsheet '{title}': {total:,} cells, {total / CELL_LIMIT:.1%} of the {CELL_LIMIT:,} limit ({largest})"
+    if total >= CELL_WARN_SHARE * CELL_LIMIT:
+        logging.warning(f"⚠ {msg}")
+    else:
+        logging.info(f"→ {msg}")
+    return total
+
+
+def _cell(v):
+    # RAW: значение как есть — числа числами, остальное строкой
+    if isinstance(v, (bool, np.bool_)):
+        return {"userEnteredValue": {"boolValue": bool(v)}}
+    if isinstance(v, (int, float, np.integer, np.floating)):
+        return {"userEnteredValue": {"numberValue": float(v) if isinstance(v, (float, np.floating)) else int(v)}}
+    return {"userEnteredValue": {"stringValue": str(v)}}
+
+
+def _write_request(ws, values, option, row, col):
+    """Запись как запрос batchUpdate: RAW — updateCells, USER_ENTERED — pasteData (разбор как при вводе)."""
+    start = {"sheetId": ws.id, "rowIndex": row - 1, "columnIndex": col - 1}
+    if option == "RAW":
+        return {"updateCells": {"start": start, "fields": "userEnteredValue",
+                                "rows": [{"values": [_cell(v) for v in r]} for r in values]}}
+    if any(isinstance(v, str) and ("\t" in v or "\n" in v or "\r" in v) for r in values for v in r):
+        return None   # табы/переводы строк внутри значений pasteData не передать
+    data = "\n".join("\t".join(str(v) for v in r) for r in values)
+    return {"pasteData": {"coordinate": start, "data": data, "type": "PASTE_NORMAL", "delimiter": "\t"}}
+
+
+def _rows_empty(ws, first, last, deadline=None):
+    """True, если в строках first..last листа нет ни одного значения ни в одной колонке."""
+    a1 = f"A{first}:{rowcol_to_a1(last, max(ws.col_count, 1))}"
+    resp = read_call(lambda: ws.spreadsheet.values_get(absolute_range_name(ws.title, a1)),
+                     f"values_get:{ws_ss_id(ws)}", deadline, ws.client)
+    return not any(any(cell != "" for cell in r) for r in resp.get("values", []))
+
+
+def _grid_request(ws, last_row, last_col, deadline):
+    """
+    Сетка = данные + GRID_HEADROOM строк (колонки только растут). Строки подрезаем,
+    только если в отрезаемых нет значений ни в одной колонке (скрипт мог очистить
+    лишь свои колонки) — иначе сетка не уменьшается. → (rows, cols, запрос batchUpdate).
+    """
+    rows, cols = last_row + GRID_HEADROOM, max(last_col, ws.col_count)
+    if rows < ws.row_count and not _rows_empty(ws, rows + 1, ws.row_count, deadline):
+        logging.warning(f"⚠ '{ws.title}' has values below row {rows}, not shrinking the grid")
+        rows = ws.row_count
+    return rows, cols, {"updateSheetProperties": {
+        "properties": {"sheetId": ws.id, "gridProperties": {"rowCount": rows, "columnCount": cols}},
+        "fields": "gridProperties.rowCount,gridProperties.columnCount",
+    }}
+
+
+def _grid_done(ws, rows, cols, resp):
+    if rows != ws.row_count or cols != ws.col_count:
+        logging.info(f"Grid of '{ws.title}' {ws.row_count}x{ws.col_count} → {rows}x{cols}")
+    ws._properties["gridProperties"].update(rowCount=rows, columnCount=cols)
+    if resp and "updatedSpreadsheet" in resp:
+        log_cell_usage(resp["updatedSpreadsheet"])
+
+
+def compact_grid(ws, last_row, last_col, deadline=None):
+    """
+    Подгонка сетки под данные отдельным batchUpdate — для записи кусками
+    (write_dataframe без compact на каждый кусок, затем один compact_grid по итоговой границе).
+    """
+    rows, cols, req = _grid_request(ws, last_row, last_col, deadline)
+    if rows == ws.row_count and cols == ws.col_count:
+        return
+    body = {"requests": [req], "includeSpreadsheetInResponse": True, "responseIncludeGridData": False}
+    resp = write_call(lambda: ws.spreadsheet.batch_update(body), deadline, ws.client)
+    _grid_done(ws, rows, cols, resp)
+
+
+def _write_compact(ws, values, option, row, col, last_row, last_col, deadline):
+    """
+    Сетка подгоняется (_grid_request) в том же batchUpdate, что и запись;
+    метаданные таблицы из ответа — для учёта ячеек.
+    """
+    rows, cols, grid = _grid_request(ws, last_row, last_col, deadline)
+    reqs = [grid]
+    write = _write_request(ws, values, option, row, col)
+    a1 = f"{rowcol_to_a1(row, col)}:{rowcol_to_a1(last_row, last_col)}"
+    if write is not None:
+        reqs.append(write)
+    body = {"requests": reqs, "includeSpreadsheetInResponse": True, "responseIncludeGridData": False}
+    resp = write_call(lambda: ws.spreadsheet.batch_update(body), deadline, ws.client)
+    if write is None:
+        # значения с табами/переводами строк: сетка уже подогнана, пишем отдельным values.update
+        write_call(lambda: ws.spreadsheet.values_update(
+            absolute_range_name(ws.title, a1), params={"valueInputOption": option}, body={"values": values},
+        ), deadline, ws.client)
+
+    _grid_done(ws, rows, cols, resp)
+    logging.info(f"batchUpdate {a1} ({option}{', write via values.update' if write is None else ''}), "
+                 f"{len(values)} rows")
+    return len(values)
+
+
+def write_dataframe(ws, df, row=1, col=1, include_column_header=True, schema=None, deadline=None, compact=False):
+    """
+    Замена gspread_dataframe.set_with_dataframe: payload строится векторно,
+    сетка листа расширяется только если данные в неё не помещаются,
+    и всё уходит одним values.update.
+    compact=True — сетку подрезаем/расширяем до данных + GRID_HEADROOM строк тем же
+    batchUpdate, что и запись; строки с чужими значениями ниже данных не подрезаются.
+    """
+    values, option = build_payload(df, include_column_header, schema)
+    if not values:
+        return 0
+
+    last_row = row + len(values) - 1
+    last_col = col + max(df.shape[1], 1) - 1
+    if compact:
+        return _write_compact(ws, values, option, row, col, last_row, last_col, deadline)
+    if last_row > ws.row_count or last_col > ws.col_count:
+        rows, cols = max(last_row, ws.row_count), max(last_col, ws.col_count)
+        logging.info(f"Resizing '{ws.title}' to {rows}x{cols}")
+        write_call(lambda: ws.resize(rows=rows, cols=cols), deadline, ws.client)
+
+    a1 = f"{rowcol_to_a1(row, col)}:{rowcol_to_a1(last_row, last_col)}"
+    write_call(lambda: ws.spreadsheet.values_update(
+        absolute_range_name(ws.title, a1),
+        params={"valueInputOption": option},
+        body={"values": values},
+    ), deadline, ws.client)
+    logging.info(f"values.update {a1} ({option}), {len(values)} rows")
+    return len(values)
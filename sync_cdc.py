@@ -0,0 +1,237 @@
+#!/usr/bin/env python3
+"""
+Change-data-capture по джобам: после успешной записи сравниваем новый кадр
+со снапшотом прошлого прогона (hash join по ключу) и пишем changelog JSONL
+со строками added / removed / modified. Снапшот — pickle-кадры подряд в одном
+gzip, так что результат, записанный кусками, и хэшируется, и сохраняется по куску.
+
+    .sync_state/snapshots/<job>.pkl.gz
+    .sync_state/changes/<job>/<UTC timestamp>.jsonl
+"""
+import os
+import gzip
+import json
+import time
+import pickle
+import logging
+from dataclasses import dataclass
+from datetime import datetime, timezone
+
+import numpy as np
+import pandas as pd
+
+from sheets_io import STATE_DIR
+from sync_jobs import get_job
+from sync_store import apply_delta, invalidate
+from sync_parallel import hash_rows
+
+# —————————————————————————————
+SNAPSHOT_DIR   = os.path.join(STATE_DIR, "snapshots")
+CHANGES_DIR    = os.path.join(STATE_DIR, "changes")
+RETENTION_DAYS = int(os.environ.get("CDC_RETENTION_DAYS", "14"))
+# —————————————————————————————
+
+
+@dataclass
+class Delta:
+    added: pd.DataFrame
+    removed: pd.DataFrame
+    modified: pd.DataFrame       # новые версии строк
+    modified_old: pd.DataFrame   # старые версии тех же строк (тот же порядок)
+
+    @property
+    def empty(self):
+        return self.added.empty and self.removed.empty and self.modified.empty
+
+    def summary(self):
+        return f"+{len(self.added)} −{len(self.removed)} ~{len(self.modified)}"
+
+
+def _hashes(df, key_cols=None):
+    """(хэш ключевых колонок или всей строки, хэш всей строки) — uint64 на строку."""
+    row_hash = hash_rows(df)
+    return (row_hash if key_cols is None else hash_rows(df.iloc[:, key_cols])), row_hash
+
+
+def key_frame(hashes):
+    """
+    _key / _row по кускам [(key_hash, row_hash)]; при повторяющемся ключе добавляем
+    номер вхождения _n, чтобы join был один-к-одному. _pos — позиция строки в кадре.
+    """
+    keys = pd.DataFrame({
+        "_key": np.concatenate([k for k, _ in hashes]) if hashes else np.empty(0, dtype=np.uint64),
+        "_row": np.concatenate([r for _, r in hashes]) if hashes else np.empty(0, dtype=np.uint64),
+    })
+    keys["_n"] = keys.groupby("_key").cumcount()
+    keys["_pos"] = np.arange(len(keys), dtype=np.int64)
+    return keys
+
+
+def diff_keys(ko, kn):
+    """Hash join по (_key, _n) → позиции added (новые), removed (старые), пары modified (новые, старые)."""
+    joined = ko.merge(kn, on=["_key", "_n"], how="outer", suffixes=("_old", "_new"), indicator=True)
+    added = np.sort(joined.loc[joined["_merge"] == "right_only", "_pos_new"].to_numpy(dtype=np.int64))
+    removed = np.sort(joined.loc[joined["_merge"] == "left_only", "_pos_old"].to_numpy(dtype=np.int64))
+    both = joined[(joined["_merge"] == "both") & (joined["_row_old"] != joined["_row_new"])]
+    return added, removed, both["_pos_new"].to_numpy(dtype=np.int64), both["_pos_old"].to_numpy(dtype=np.int64)
+
+
+def take_rows(frames, positions, columns):
+    """Строки по позициям сквозной нумерации кусков frames, в порядке positions; в памяти — только выбранное."""
+    positions = np.asarray(positions, dtype=np.int64)
+    order = np.argsort(positions, kind="stable")
+    wanted = positions[order]
+    parts, start = [], 0
+    for frame in frames:
+        lo, hi = np.searchsorted(wanted, [start, start + len(frame)])
+        if hi > lo:
+            parts.append(frame.iloc[wanted[lo:hi] - start])
+        start += len(frame)
+        if hi == len(wanted):
+            break
+    taken = pd.concat(parts, ignore_index=True) if parts else pd.DataFrame(columns=columns)
+    return taken.iloc[np.argsort(order)].reset_index(drop=True)
+
+
+def _snapshot_path(job):
+    return os.path.join(SNAPSHOT_DIR, f"{job}.pkl.gz")
+
+
+def _read_frames(path):
+    """Куски снапшота: pickle-кадры подряд в одном gzip (старый снапшот — один кадр)."""
+    with gzip.open(path, "rb") as f:
+        while True:
+            try:
+                yield pickle.load(f)
+            except EOFError:
+                return
+
+
+def load_snapshot(job):
+    path = _snapshot_path(job)
+    if not os.path.exists(path):
+        return None
+    try:
+        return pd.concat(list(_read_frames(path)), ignore_index=True)
+    except Exception as e:
+        logging.warning(f"Snapshot for {job} is unreadable ({e}), treating run as initial load")
+        return None
+
+
+def _snapshot_keys(job, columns, key_cols):
+    """key_frame старого снапшота по кускам; None — снапшота нет, он битый или колонки сменились."""
+    path = _snapshot_path(job)
+    if not os.path.exists(path):
+        return None
+    hashes = []
+    try:
+        for frame in _read_frames(path):
+            if list(frame.columns) != columns:
+                logging.warning(f"{job}: columns changed since last snapshot, logging full reload")
+                return None
+            hashes.append(_hashes(frame, key_cols))
+    except Exception as e:
+        logging.warning(f"Snapshot for {job} is unreadable ({e}), treating run as initial load")
+        return None
+    return key_frame(hashes)
+
+
+def unique_columns(df):
+    """Имена колонок, сделанные уникальными: пустые и повторяющиеся заголовки у листов не редкость."""
+    names, seen = [], {}
+    for c in map(str, df.columns):
+        names.append(c if c not in seen else f"{c}.{seen[c]}")
+        seen[c] = seen.get(c, 0) + 1
+    return names
+
+
+def _records(df):
+    """(значения строки, dict с уникальными именами колонок)."""
+    names = unique_columns(df)
+    for values in df.astype(object).where(df.notna(), None).itertuples(index=False, name=None):
+        yield list(values), dict(zip(names, values))
+
+
+def write_changelog(job, delta, key_cols=None):
+    run_at = datetime.now(timezone.utc)
+    job_dir = os.path.join(CHANGES_DIR, job)
+    os.makedirs(job_dir, exist_ok=True)
+    path = os.path.join(job_dir, run_at.strftime("%Y%m%dT%H%M%S%fZ") + ".jsonl")
+
+    def key_of(values):
+        return None if key_cols is None else [values[i] for i in key_cols]
+
+    with open(path, "w", encoding="utf-8") as f:
+        for op, frame in (("added", delta.added), ("removed", delta.removed)):
+            for values, row in _records(frame):
+                f.write(json.dumps({"run_at": run_at.isoformat(), "job": job, "op": op,
+                                    "key": key_of(values), "row": row}, ensure_ascii=False) + "\n")
+        for (values, new), (_, old) in zip(_records(delta.modified), _records(delta.modified_old)):
+            f.write(json.dumps({"run_at": run_at.isoformat(), "job": job, "op": "modified",
+                                "key": key_of(values), "row": new, "old": old}, ensure_ascii=False) + "\n")
+    _prune(job_dir)
+    return path
+
+
+def _prune(job_dir):
+    cutoff = time.time() - RETENTION_DAYS * 86400
+    for name in os.listdir(job_dir):
+        path = os.path.join(job_dir, name)
+        if os.path.getmtime(path) < cutoff:
+            os.remove(path)
+
+
+def capture_changes(job, df):
+    """
+    Вызывать после успешной записи в целевой лист: считает дельту к прошлому
+    прогону (ключ — JobSpec.key_cols), пишет changelog и обновляет снапшот.
+    Возвращает Delta.
+    """
+    return capture_chunks(job, [df], list(df.columns))
+
+
+def capture_chunks(job, chunks, columns):
+    """
+    То же для результата, записанного кусками (chunks — кадры по порядку, колонки columns):
+    снапшот пишется и хэшируется по куску, старый снапшот читается так же, целиком
+    в памяти — только хэши и строки дельты.
+    """
+    key_cols = get_job(job).key_cols
+    path = _snapshot_path(job)
+    tmp = path + ".tmp"
+    os.makedirs(SNAPSHOT_DIR, exist_ok=True)
+    hashes, total = [], 0
+    try:
+        with gzip.open(tmp, "wb") as f:
+            for chunk in chunks:
+                pickle.dump(chunk, f, protocol=pickle.HIGHEST_PROTOCOL)
+                hashes.append(_hashes(chunk, key_cols))
+                total += len(chunk)
+            if not hashes:
+                pickle.dump(pd.DataFrame(columns=columns), f, protocol=pickle.HIGHEST_PROTOCOL)
+    except BaseException:
+        os.remove(tmp)      # запись упала посреди кусков — старый снапшот остаётся как был
+        raise
+
+    ko = _snapshot_keys(job, columns, key_cols)
+    full = ko is None
+    added, removed, mod_new, mod_old = diff_keys(key_frame([]) if full else ko, key_frame(hashes))
+    new_rows = take_rows(_read_frames(tmp), np.concatenate([added, mod_new]), columns)
+    old_rows = (take_rows(_read_frames(path), np.concatenate([removed, mod_old]), columns)
+                if not full else pd.DataFrame(columns=columns))
+    delta = Delta(added=new_rows.iloc[:len(added)], removed=old_rows.iloc[:len(removed)],
+                  modified=new_rows.iloc[len(added):], modified_old=old_rows.iloc[len(removed):])
+
+    changelog = write_changelog(job, delta, key_cols)
+    os.replace(tmp, path)
+    logging.info(f"✔ CDC {job}: {delta.summary()} → {changelog}")
+    try:
+        apply_delta(job, _read_frames(path), delta, total, key_cols, full=full)
+    except Exception as e:
+        # локальная копия вторична — джоб из-за неё не падает, в следующий раз перезальём
+        logging.warning(f"⚠ Store update for {job} failed ({e}), it will be reloaded next run")
+        try:
+            invalidate(job)
+        except Exception:
+            pass
+    return delta
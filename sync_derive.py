@@ -0,0 +1,161 @@
+#!/usr/bin/env python3
+"""
+Локальные join / group-by стадии (sync_jobs.DERIVED) поверх последних
+результатов джобов: берём снапшоты CDC, делаем hash join (pandas merge)
+и агрегаты в памяти и публикуем компактную вкладку — таблице больше не
+нужно пересчитывать VLOOKUP/QUERY по всему QA после каждой перезаливки.
+
+Если результат не изменился с прошлой публикации, к API не обращаемся вовсе.
+Стадии с publish=False только собираются (проверка заголовков и объёма) — без записи.
+"""
+import os
+import json
+import hashlib
+import logging
+
+import pandas as pd
+from gspread.exceptions import WorksheetNotFound
+
+from sheets_io import STATE_DIR, Deadline, authorize, api_retry_open, api_retry_worksheet, write_call, write_dataframe
+from sync_cdc import load_snapshot, unique_columns
+from sync_parallel import hash_rows
+
+# —————————————————————————————
+PUBLISHED_PATH = os.path.join(STATE_DIR, "derived.json")
+MEAN_DIGITS    = 2
+# —————————————————————————————
+
+
+def _key(s):
+    return s.astype(str).str.strip()
+
+
+def _position(names, header, where):
+    """Позиция колонки по заголовку; нет такого — ошибка со списком настоящих заголовков."""
+    if header not in names:
+        raise ValueError(f"no column '{header}' in {where}; columns: {', '.join(names)}")
+    return names.index(header)
+
+
+def join_frames(spec, left, right):
+    """left ⨝ right по ключу; справа берём первую строку на ключ, чтобы join не размножал строки left."""
+    names = unique_columns(left)
+    left_on = _position(names, spec.left_on, spec.left)
+    joined = left.set_axis([f"l{i}" for i in range(left.shape[1])], axis=1)
+    joined["_key"] = joined[f"l{left_on}"] = _key(joined[f"l{left_on}"])
+    if right is None:
+        return joined.drop(columns="_key"), names
+
+    right_names = unique_columns(right)
+    cols = ([_position(right_names, c, spec.right) for c in spec.right_cols] if spec.right_cols is not None
+            else list(range(right.shape[1])))
+    r = right.iloc[:, cols].set_axis([f"r{i}" for i in range(len(cols))], axis=1)
+    r["_key"] = _key(right.iloc[:, _position(right_names, spec.right_on, spec.right)])
+    dups = r["_key"].duplicated()
+    if dups.any():
+        logging.warning(f"⚠ {spec.name}: {int(dups.sum())} duplicate keys in {spec.right}, keeping the first")
+        r = r[~dups]
+    joined = joined.merge(r, on="_key", how=spec.how, sort=False).drop(columns="_key")
+    # совпавшие с left заголовки справа получают суффикс .1, как у unique_columns
+    return joined, unique_columns(pd.DataFrame(columns=names + [right_names[c] for c in cols]))
+
+
+def aggregate(spec, joined, names):
+    if not spec.group_by:
+        return joined.set_axis(names, axis=1)
+    group_by = [_position(names, h, spec.name) for h in spec.group_by]
+    by = [joined.columns[i] for i in group_by]
+    groups = joined.groupby(by, dropna=False, sort=True)
+    result = groups.size().rename("_size").reset_index()
+    for agg in spec.aggregates:
+        if agg.func == "count":
+            values = groups.size()
+        elif agg.func == "nunique":
+            values = groups[joined.columns[_position(names, agg.col, spec.name)]].nunique()
+        else:
+            num = pd.to_numeric(joined[joined.columns[_position(names, agg.col, spec.name)]], errors="coerce")
+            values = num.groupby([joined[c] for c in by], dropna=False, sort=True).agg(agg.func)
+            if agg.func == "mean":
+                values = values.round(MEAN_DIGITS)
+        result[agg.name] = values.to_numpy()
+    result = result.drop(columns="_size")
+    return result.set_axis([names[i] for i in group_by] + [a.name for a in spec.aggregates], axis=1)
+
+
+def build(spec):
+    left = load_snapshot(spec.left)
+    right = load_snapshot(spec.right) if spec.right else None
+    if left is None or (spec.right and right is None):
+        logging.warning(f"⚠ {spec.name}: no snapshot of {spec.left if left is None else spec.right} yet, skipping")
+        return None
+    joined, names = join_frames(spec, left, right)
+    df = aggregate(spec, joined, names)
+    logging.info(f"→ {spec.name}: {len(left)} rows of {spec.left} → {len(df)} result rows")
+    return df
+
+
+def _digest(df):
+    h = hashlib.sha1(json.dumps([str(c) for c in df.columns]).encode())
+    h.update(hash_rows(df).tobytes())
+    return h.hexdigest()
+
+
+def _load_published():
+    try:
+        with open(PUBLISHED_PATH, encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def _save_published(state):
+    os.makedirs(os.path.dirname(PUBLISHED_PATH) or ".", exist_ok=True)
+    tmp = PUBLISHED_PATH + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(state, f, indent=1, sort_keys=True)
+    os.replace(tmp, PUBLISHED_PATH)
+
+
+def publish(spec, df, client, deadline=None):
+    dst = spec.dest
+    sh = api_retry_open(client, dst.ss_id, deadline, write=True)
+    try:
+        ws = api_retry_worksheet(sh, dst.sheet, deadline)
+    except WorksheetNotFound:
+        logging.info(f"→ Creating tab '{dst.sheet}'")
+        ws = write_call(lambda: sh.add_worksheet(dst.sheet, rows=len(df) + 1, cols=max(1, df.shape[1])),
+                        deadline, sh.client)
+    if deadline is not None:
+        deadline = deadline.write_phase()   # до очистки: хватит ли бюджета, дальше — свой
+    if dst.clear_range:
+        write_call(lambda: ws.batch_clear([dst.clear_range]), deadline, ws.client)
+    else:
+        write_call(ws.clear, deadline, ws.client)
+    write_dataframe(ws, df, row=dst.start_row, include_column_header=dst.header, deadline=deadline, compact=dst.compact)
+
+
+def run_derived(specs, client=None, force_publish=False):
+    """force_publish — писать и стадии с publish=False (ручной `derive --publish` после проверки)."""
+    published = _load_published()
+    failed = False
+    for spec in specs:
+        try:
+            df = build(spec)
+            if df is None:
+                continue
+            if not (spec.publish or force_publish):
+                logging.info(f"✔ {spec.name}: built {len(df)} rows, not published (publish=False)")
+                continue
+            digest = _digest(df)
+            if published.get(spec.name) == digest:
+                logging.info(f"✔ {spec.name}: result unchanged, nothing to publish")
+                continue
+            client = client or authorize()
+            publish(spec, df, client, Deadline.from_env(spec.name))
+            published[spec.name] = digest
+            _save_published(published)
+            logging.info(f"✔ {spec.name}: published {len(df)} rows to '{spec.dest.sheet}'")
+        except Exception as e:
+            failed = True
+            logging.error(f"✖ {spec.name} failed: {e}")
+    return 1 if failed else 0
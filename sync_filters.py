@@ -0,0 +1,165 @@
+#!/usr/bin/env python3
+"""
+Фильтр строк на этапе чтения (SourceSpec.filters): regex / равенство / окно
+дат по любой колонке источника, считается векторно по pandas.
+
+Если у источника есть окно дат с order="asc"/"desc" (строки упорядочены по
+этой колонке), лист читается окнами по WINDOW_ROWS строк, каждое окно сразу
+фильтруется, и чтение останавливается, как только окно дат пройдено или
+кончились строки листа (пустые окна посреди листа пропускаются, не обрывают
+чтение). Результат — по тому же правилу, что и у sync_strategies (normalize_frame).
+"""
+import os
+import logging
+
+import pandas as pd
+from gspread.utils import rowcol_to_a1
+
+from sheets_io import read_call, ws_ss_id
+from sync_jobs import get_job
+from sync_strategies import normalize_frame
+from sync_profile import note_input
+from sync_freshness import note_fetched
+
+# —————————————————————————————
+WINDOW_ROWS = int(os.environ.get("SYNC_READ_WINDOW_ROWS", "5000"))
+# —————————————————————————————
+
+
+def _dates(f, s):
+    return pd.to_datetime(s, errors="coerce", dayfirst=f.dayfirst)
+
+
+def _bounds(f):
+    lo = pd.Timestamp(f.date_from) if f.date_from else None
+    hi = pd.Timestamp(f.date_to) if f.date_to else None
+    if f.last_days:
+        lo = pd.Timestamp.now().normalize() - pd.Timedelta(days=f.last_days)
+    return lo, hi
+
+
+def filter_mask(f, s):
+    """Булева маска по одной колонке (Series) для одного RowFilter."""
+    mask = pd.Series(True, index=s.index)
+    if f.regex:
+        mask &= s.astype(str).str.contains(f.regex, regex=True, na=False)
+    if f.equals is not None:
+        values = f.equals if isinstance(f.equals, (list, tuple, set)) else [f.equals]
+        mask &= s.isin([str(v) for v in values])
+    lo, hi = _bounds(f)
+    if lo is not None or hi is not None:
+        d = _dates(f, s)
+        if lo is not None:
+            mask &= d >= lo
+        if hi is not None:
+            mask &= d < hi
+    return mask
+
+
+def window_passed(f, s):
+    """Для упорядоченного источника: дальше в листе строк из окна дат уже не будет."""
+    lo, hi = _bounds(f)
+    d = _dates(f, s).dropna()
+    if d.empty or not f.order:
+        return False
+    if f.order == "asc":
+        return hi is not None and d.iloc[-1] >= hi
+    return lo is not None and d.iloc[-1] < lo
+
+
+def _position(src, f):
+    if src.cols is None:
+        return f.col
+    if f.col not in src.cols:
+        raise ValueError(f"filter column {f.col} is not among fetched columns {src.cols}")
+    return src.cols.index(f.col)
+
+
+def apply_filters(src, df):
+    if df is None or df.empty or not src.filters:
+        return df
+    mask = pd.Series(True, index=df.index)
+    for f in src.filters:
+        mask &= filter_mask(f, df.iloc[:, _position(src, f)])
+    return df[mask.to_numpy()].reset_index(drop=True)
+
+
+def _window_frame(batch, cols, start, end, header):
+    """Ответ batch_get за окно строк → DataFrame с выравниванием по длине окна."""
+    n = end - start + 1
+    if cols is None:
+        rows = batch[0] if batch else []
+        width = max((len(r) for r in rows), default=len(header))
+        rows = [r + [""] * (width - len(r)) for r in rows]
+        return pd.DataFrame(rows, columns=(header + [""] * width)[:width]) if rows else None
+    col_values = []
+    for col in batch:
+        flat = [r[0] if r else "" for r in col]
+        col_values.append(flat + [""] * (n - len(flat)))
+    if not any(any(v for v in c) for c in col_values):
+        return None
+    return pd.DataFrame(dict(enumerate(col_values))).set_axis(header, axis=1)
+
+
+def fetch_filtered_windows(ws, src, deadline=None, window=WINDOW_ROWS):
+    """Чтение окнами до ws.row_count с фильтрацией каждого окна и ранней остановкой по окну дат."""
+    ordered = [f for f in src.filters if f.order]
+    letters = None if src.cols is None else \
+        ["".join(filter(str.isalpha, rowcol_to_a1(1, c + 1))) for c in src.cols]
+
+    def ranges(start, end):
+        if letters is None:
+            return [f"{start}:{end}"]
+        return [f"{col}{start}:{col}{end}" for col in letters]
+
+    head = read_call(lambda: ws.batch_get(ranges(1, 1)), f"batch_get:{ws_ss_id(ws)}", deadline, ws.client)
+    if letters is None:
+        header = head[0][0] if head and head[0] else []
+    else:
+        header = [c[0][0] if c and c[0] else "" for c in head]
+
+    parts, start, scanned = [], 2, 0
+    while start <= ws.row_count:
+        end = min(start + window - 1, ws.row_count)
+        rng = ranges(start, end)
+        batch = read_call(lambda: ws.batch_get(rng), f"batch_get:{ws_ss_id(ws)}", deadline, ws.client)
+        frame = _window_frame(batch, src.cols, start, end, header)
+        if frame is None:
+            start = end + 1   # пустой разрыв — строки могут быть и ниже
+            continue
+        scanned += len(frame)
+        parts.append(apply_filters(src, frame))
+        if any(window_passed(f, frame.iloc[:, _position(src, f)]) for f in ordered):
+            logging.info(f"→ Date window passed at row {end}, stopping read early")
+            break
+        start = end + 1
+
+    note_input(scanned)
+    df = normalize_frame(pd.concat(parts, ignore_index=True) if parts else pd.DataFrame(columns=header))
+    logging.info(f"→ Windowed read: scanned {scanned} rows, kept {len(df)}")
+    return df
+
+
+def apply_job_filters(job_name, source_idx, df):
+    """Векторный фильтр строк уже прочитанного кадра источника (без окон)."""
+    src = get_job(job_name).sources[source_idx]
+    before = 0 if df is None else len(df)
+    note_input(before)
+    note_fetched(job_name)
+    df = apply_filters(src, df)
+    if src.filters and df is not None:
+        logging.info(f"→ Row filter kept {len(df)} of {before} rows")
+    return df
+
+
+def filtered_read(job_name, source_idx, ws, fetch, deadline=None):
+    """
+    Чтение источника джоба с фильтром строк: окнами с ранней остановкой, если
+    есть упорядоченное окно дат, иначе обычный fetch() и векторный фильтр.
+    """
+    src = get_job(job_name).sources[source_idx]
+    if any(f.order for f in src.filters):
+        df = fetch_filtered_windows(ws, src, deadline)
+        note_fetched(job_name)
+        return df
+    return apply_job_filters(job_name, source_idx, fetch())
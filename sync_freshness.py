@@ -0,0 +1,238 @@
+#!/usr/bin/env python3
+"""
+Свежесть данных в целевых вкладках, а не только «скрипт завершился с 0».
+
+По каждому джобу копим в STATE_DIR/freshness.json:
+  • синхронизации — modifiedTime источника (Drive, версия на момент чтения),
+    время окончания чтения и время окончания записи;
+  • наблюдения staleness — насколько вкладка отстаёт от источника в момент
+    проверки: 0, если версия источника та же, что при последней синхронизации,
+    иначе now − modifiedTime (нижняя оценка: Drive отдаёт только последнюю правку).
+
+Из них за окно WINDOW_DAYS считаем перцентили staleness и sync lag
+(публикация − modifiedTime источника) и сверяем с целью джоба
+(JobSpec.freshness_target, минуты; по умолчанию max_interval + TARGET_SLACK).
+Итог печатается в сводке run/tick и пишется в текстовый файл метрик
+в формате Prometheus (node_exporter textfile collector).
+
+    python sync_jobs.py freshness [job ...]
+"""
+import os
+import json
+import time
+import logging
+import threading
+from datetime import datetime
+
+from sheets_io import STATE_DIR
+
+# —————————————————————————————
+FRESHNESS_PATH = os.path.join(STATE_DIR, "freshness.json")
+METRICS_PATH   = os.environ.get("SYNC_METRICS_PATH", os.path.join(STATE_DIR, "metrics", "sync_freshness.prom"))
+WINDOW_DAYS    = float(os.environ.get("SYNC_FRESHNESS_WINDOW_DAYS", "7"))
+MAX_SAMPLES    = 500       # на джоб и вид выборки
+QUANTILES      = (0.5, 0.9, 0.99)
+SLO_QUANTILE   = 0.9       # с целью сверяем p90
+TARGET_SLACK   = 60        # минуты к max_interval, если цель не задана
+OVERPOLL_SHARE = 0.25      # p90 lag < 25% цели и источник почти не меняется — опрашиваем чаще, чем нужно
+# —————————————————————————————
+
+_fetched = {}            # job → время окончания последнего чтения в этом процессе
+_lock = threading.Lock()
+
+
+def parse_time(value):
+    """RFC 3339 из Drive (2024-05-01T10:00:00.000Z) → unix time; None, если не разобрали."""
+    if not value:
+        return None
+    try:
+        return datetime.fromisoformat(value.replace("Z", "+00:00")).timestamp()
+    except ValueError:
+        return None
+
+
+def source_modified(versions, ids=None):
+    """Последняя правка среди источников джоба (unix time) или None."""
+    times = [parse_time(v.get("modifiedTime")) for i, v in versions.items() if ids is None or i in ids]
+    times = [t for t in times if t is not None]
+    return max(times) if times else None
+
+
+def target_minutes(job):
+    return job.freshness_target if job.freshness_target is not None else job.max_interval + TARGET_SLACK
+
+
+def load_state():
+    try:
+        with open(FRESHNESS_PATH, encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def _save_state(state):
+    os.makedirs(os.path.dirname(FRESHNESS_PATH) or ".", exist_ok=True)
+    tmp = FRESHNESS_PATH + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(state, f, indent=1, sort_keys=True)
+    os.replace(tmp, FRESHNESS_PATH)
+
+
+def _append(job_name, kind, sample):
+    cutoff = time.time() - WINDOW_DAYS * 86400
+    with _lock:
+        state = load_state()
+        e = state.setdefault(job_name, {"syncs": [], "observations": []})
+        e[kind] = [s for s in e[kind] if s[0] >= cutoff][-(MAX_SAMPLES - 1):] + [sample]
+        try:
+            _save_state(state)
+        except OSError as err:
+            logging.warning(f"Could not save freshness state: {err}")
+
+
+def note_fetched(job_name):
+    """Чтение источника закончено — вызывается из sync_filters."""
+    with _lock:
+        _fetched[job_name] = time.time()
+
+
+def observe(job_name, versions, last_versions):
+    """
+    Наблюдение staleness по текущим версиям Drive и версиям последней синхронизации.
+    versions — по всем источникам джоба; пустые versions (Drive не ответил) не наблюдение.
+    """
+    if not versions:
+        return
+    now = time.time()
+    stale = [i for i in versions if i not in last_versions or versions[i].get("version") != last_versions[i].get("version")]
+    modified = source_modified(versions, set(stale))
+    staleness = 0.0 if not stale else max(0.0, now - modified) if modified is not None else None
+    if staleness is not None:
+        _append(job_name, "observations", [round(now, 1), round(staleness, 1)])
+
+
+def record_sync(job_name, versions):
+    """Запись в целевой лист закончена — вызывается из mark_synced."""
+    now = time.time()
+    with _lock:
+        fetched = _fetched.pop(job_name, None)
+    modified = source_modified(versions)
+    _append(job_name, "syncs", [round(now, 1), modified and round(modified, 1), fetched and round(fetched, 1)])
+
+
+def percentile(values, q):
+    """Перцентиль с линейной интерполяцией; None для пустой выборки."""
+    if not values:
+        return None
+    values = sorted(values)
+    pos = (len(values) - 1) * q
+    lo = int(pos)
+    hi = min(lo + 1, len(values) - 1)
+    return values[lo] + (values[hi] - values[lo]) * (pos - lo)
+
+
+def job_report(job, state=None, now=None):
+    now = now or time.time()
+    e = (state if state is not None else load_state()).get(job.name, {})
+    cutoff = now - WINDOW_DAYS * 86400
+    syncs = [s for s in e.get("syncs", []) if s[0] >= cutoff]
+    observations = [o for o in e.get("observations", []) if o[0] >= cutoff]
+
+    lag = [s[0] - s[1] for s in syncs if s[1] is not None]
+    publish = [s[0] - s[2] for s in syncs if s[2] is not None]
+    staleness = [o[1] for o in observations]
+    target = target_minutes(job) * 60
+    worst = max((v for v in (percentile(staleness, SLO_QUANTILE), percentile(lag, SLO_QUANTILE)) if v is not None),
+                default=None)
+    idle_share = sum(1 for v in staleness if v == 0) / len(staleness) if staleness else None
+
+    if worst is None:
+        status = "no data"
+    elif worst > target:
+        status = "BREACH"        # отстаёт сильнее цели — опрашивать чаще
+    elif worst < OVERPOLL_SHARE * target and idle_share is not None and idle_share > 1 - OVERPOLL_SHARE:
+        status = "over-polled"   # источник почти всегда без изменений, а отставание далеко от цели
+    else:
+        status = "ok"
+    return {
+        "job": job.name,
+        "target": target,
+        "status": status,
+        "staleness": {q: percentile(staleness, q) for q in QUANTILES},
+        "lag": {q: percentile(lag, q) for q in QUANTILES},
+        "publish": {q: percentile(publish, q) for q in QUANTILES},
+        "samples": (len(staleness), len(lag)),
+        "last_sync": syncs[-1][0] if syncs else None,
+        "source_modified": syncs[-1][1] if syncs else None,
+    }
+
+
+def _fmt(seconds):
+    if seconds is None:
+        return "—"
+    if seconds < 90:
+        return f"{seconds:.0f}s"
+    if seconds < 90 * 60:
+        return f"{seconds / 60:.0f}m"
+    return f"{seconds / 3600:.1f}h"
+
+
+def print_report(reports):
+    print(f"\n== Freshness (last {WINDOW_DAYS:g} days, p50/p90/p99; SLO on p{SLO_QUANTILE * 100:.0f})")
+    for r in reports:
+        st = "/".join(_fmt(r["staleness"][q]) for q in QUANTILES)
+        lag = "/".join(_fmt(r["lag"][q]) for q in QUANTILES)
+        mark = {"BREACH": "✖", "ok": "✔", "over-polled": "⚠"}.get(r["status"], " ")
+        print(f"  {mark} {r['job']:<28} staleness {st:<16} lag {lag:<16} target {_fmt(r['target']):>6}  {r['status']}")
+
+
+def write_metrics(reports, path=METRICS_PATH):
+    """Текстовый файл для node_exporter --collector.textfile (пишется атомарно)."""
+    lines = []
+
+    def metric(name, help_text, rows):
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} gauge")
+        for labels, value in rows:
+            if value is not None:
+                label_str = ",".join(f'{k}="{v}"' for k, v in labels.items())
+                lines.append(f"{name}{{{label_str}}} {value:.3f}")
+
+    for kind, help_text in (("staleness", "How far the destination lags its source when checked"),
+                            ("lag", "Publish time minus source modifiedTime"),
+                            ("publish", "Publish time minus fetch completion")):
+        metric(f"sync_{kind}_seconds", help_text,
+               [({"job": r["job"], "quantile": q}, r[kind][q]) for r in reports for q in QUANTILES])
+    metric("sync_freshness_target_seconds", "Per-job freshness target", [({"job": r["job"]}, r["target"]) for r in reports])
+    metric("sync_freshness_breach", "1 if the p90 staleness or lag exceeds the target",
+           [({"job": r["job"]}, float(r["status"] == "BREACH")) for r in reports if r["status"] != "no data"])
+    metric("sync_last_publish_timestamp_seconds", "Last successful publish",
+           [({"job": r["job"]}, r["last_sync"]) for r in reports])
+    metric("sync_source_modified_timestamp_seconds", "Source modifiedTime at the last publish",
+           [({"job": r["job"]}, r["source_modified"]) for r in reports])
+
+    try:
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        tmp = path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            f.write("\n".join(lines) + "\n")
+        os.replace(tmp, path)
+    except OSError as e:
+        logging.warning(f"Could not write freshness metrics to {path}: {e}")
+
+
+def report(jobs, metrics=True):
+    """
+    Сводка по джобам jobs; файл метрик — всегда по всему реестру, чтобы прогон
+    части джобов не стирал метрики остальных. True, если кто-то нарушает цель.
+    """
+    from sync_jobs import get_jobs
+
+    state = load_state()
+    reports = {job.name: job_report(job, state) for job in get_jobs()}
+    for job in jobs:
+        reports.setdefault(job.name, job_report(job, state))
+    print_report([reports[job.name] for job in jobs])
+    if metrics:
+        write_metrics(list(reports.values()))
+    return any(reports[job.name]["status"] == "BREACH" for job in jobs)
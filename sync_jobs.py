@@ -0,0 +1,360 @@
+#!/usr/bin/env python3
+"""
+Реестр синхронизаций (какой скрипт что читает и куда пишет) и CLI движка.
+
+Описания здесь повторяют константы из самих скриптов — при изменении
+SOURCE_*/DEST_*/cols_to_take в скрипте правим и запись в JOBS.
+
+    python sync_jobs.py plan [job ...] [--include-disabled]
+    python sync_jobs.py run  [job ...] [--parallel N] [--profile]
+    python sync_jobs.py derive [name ...]
+    python sync_jobs.py tick [job ...] [--dry-run]
+    python sync_jobs.py freshness [job ...]
+"""
+import os
+import re
+import sys
+import glob
+import logging
+import argparse
+import importlib.util
+from dataclasses import dataclass, field
+from typing import List, Optional
+
+from gspread.utils import a1_to_rowcol
+
+# —————————————————————————————
+REPO_DIR      = os.path.dirname(os.path.abspath(__file__))
+WORKFLOWS_DIR = os.path.join(REPO_DIR, ".github", "workflows")
+MAX_ROWS      = 10_000_000
+MAX_COLS      = 18_278       # ZZZ
+# —————————————————————————————
+
+
+@dataclass
+class RowFilter:
+    """Фильтр строк источника (sync_filters); условия внутри одного фильтра — через И."""
+    col: int                             # 0-based колонка источника
+    regex: Optional[str] = None          # строка содержит совпадение
+    equals: Optional[object] = None      # значение или список значений
+    date_from: Optional[str] = None      # окно дат [date_from, date_to)
+    date_to: Optional[str] = None
+    last_days: Optional[int] = None      # скользящее окно: date_from = сегодня − N дней
+    dayfirst: bool = False
+    order: Optional[str] = None          # asc | desc — строки листа упорядочены по этой дате
+
+
+@dataclass
+class SourceSpec:
+    ss_id: str
+    sheet: Optional[str] = None          # название листа
+    gid: Optional[int] = None            # или gid, если скрипт ищет лист по id
+    cols: Optional[List[int]] = None     # 0-based; None = все колонки
+    method: str = "batch_get"            # batch_get | get_all_values (весь лист потоком, cols — проекция)
+    filters: List[RowFilter] = field(default_factory=list)
+
+
+@dataclass
+class DestSpec:
+    ss_id: str
+    sheet: str
+    clear_range: Optional[str] = None    # None => ws.clear() всего листа
+    start_row: int = 1
+    header: bool = True
+    compact: bool = False                # сетка = данные + SHEETS_GRID_HEADROOM строк (строки с чужими значениями не режем)
+    chunked: bool = False                # пишется кусками по SYNC_SPILL_CHUNK_ROWS, compact — одним batchUpdate в конце
+
+
+@dataclass
+class JobSpec:
+    name: str
+    script: str
+    sources: List[SourceSpec]
+    dest: DestSpec
+    ncols: int                           # сколько колонок пишем
+    key_cols: Optional[List[int]] = None # ключ для CDC (позиции в выходном кадре); None = хэш всей строки
+    adaptive: bool = False               # tick без списка джобов опрашивает только такие (sync_schedule)
+    min_interval: int = 15               # границы адаптивного опроса, минуты (sync_schedule)
+    max_interval: int = 24 * 60
+    freshness_target: Optional[int] = None  # минуты, SLO на p90 staleness/lag; None = max_interval + 60 (sync_freshness)
+    schedules: List[dict] = field(default_factory=list)   # заполняется из workflows
+
+
+@dataclass
+class Aggregate:
+    name: str                            # заголовок колонки результата
+    func: str                            # count | nunique | sum | mean | min | max
+    col: Optional[str] = None            # заголовок колонки объединённого кадра; для count не нужен
+
+
+@dataclass
+class DerivedSpec:
+    """
+    Локальная стадия поверх результатов джобов (снапшоты CDC, без чтения из Sheets):
+    hash join left ⨝ right и group-by, результат — компактная вкладка вместо
+    VLOOKUP/QUERY по десяткам тысяч строк в самой таблице.
+    Колонки — по заголовкам снапшотов (строка 1 источников джоба, повторы — с суффиксом .1);
+    объединённый кадр: все колонки left, затем right_cols. Вкладка публикуется,
+    только если publish=True (или `derive --publish`), иначе результат лишь собирается.
+    """
+    name: str
+    left: str                            # имя джоба
+    dest: DestSpec
+    right: Optional[str] = None
+    left_on: str = ""
+    right_on: str = ""
+    right_cols: Optional[List[str]] = None   # какие колонки right брать (ключ добавляется сам); None = все
+    how: str = "left"
+    group_by: List[str] = field(default_factory=list)
+    aggregates: List[Aggregate] = field(default_factory=list)
+    publish: bool = False                # писать ли вкладку в dest
+
+
+TUTORS_SRC = "1xqGCXsebSmYL4bqAwvTmD9lOentI45CTMxhea-ZDFls"
+RATING_DST = "16QrbLtzLTV6GqyT8HYwzcwYIsXewzjUbM0Jy5i1fENE"
+REPORT_DST = "1SudB1YkPD0Tt7xkEiNJypRv0vb62BSdsCLrcrGqALAI"
+QA_ARCHIVE = "1R8GzRVL58XxheG0FRtSRfE6Ib5E_GcZh1Ws_iaDOpbk"
+
+JOBS = [
+    JobSpec(
+        name="QA-update", script="QA-update.py",
+        sources=[
+            SourceSpec("1gV9STzFPKMeIkVO6MFILzC-v2O6cO3XZyi4sSstgd8A", "All lesson reviews OLD", cols=[2, 3, 14, 12, 5]),
+            SourceSpec(QA_ARCHIVE, "QA Workspace Archive", cols=[0, 1, 12, 10, 3]),
+            SourceSpec(QA_ARCHIVE, "QA Workspace Graduation Archive", cols=[0, 1, 12, 11, 3]),
+        ],
+        dest=DestSpec(RATING_DST, "QA - Lesson evaluation", clear_range="A2:E", start_row=2, header=False,
+                      compact=True, chunked=True),
+        ncols=5, adaptive=True, max_interval=4 * 60,   # отзывы идут весь день — не реже, чем было по cron
+    ),
+    JobSpec(
+        name="0-students", script="0-students_disbanding.py",
+        sources=[SourceSpec("1hyK1UPn0bJYx67my12Ytbsh3uThag0v28TvY9T4-81I", "Students&Groups", cols=list(range(10)))],
+        dest=DestSpec("1XwyahhHC7uVzwfoErrvwrcruEjwewqIUp2u-6nvdSR0", "0-students", clear_range="A:J", compact=True),
+        ncols=10, key_cols=[0],   # student id
+        adaptive=True, max_interval=4 * 60,   # свой cron выключен — опрашивает sync-tick, не реже прежних 4 ч
+    ),
+    JobSpec(
+        name="ISM-update", script="ISM-update.py",
+        sources=[SourceSpec("1MBVdG-_8Bza_H5elN8rSABxSAdBqUtgpsXyS4BcRhV8", gid=2063311651, cols=[2, 4, 11, 28],
+                            method="get_all_values")],
+        dest=DestSpec(REPORT_DST, "ism_communications"),
+        ncols=4,
+    ),
+    JobSpec(
+        name="rates-update", script="rates-update.py",
+        sources=[SourceSpec(TUTORS_SRC, "Tutors", cols=[0, 1, 22, 23, 24, 18])],
+        dest=DestSpec(REPORT_DST, "rates"),
+        ncols=6, key_cols=[0],    # tutor id
+        min_interval=60, max_interval=7 * 24 * 60,   # ставки меняются раз в неделю-другую
+    ),
+    JobSpec(
+        name="update_IND", script="update_IND.py",
+        sources=[SourceSpec(TUTORS_SRC, "Students & Teachers", cols=[0])],
+        dest=DestSpec(REPORT_DST, "IND", clear_range="A:A"),
+        ncols=1,
+    ),
+    JobSpec(
+        name="update_groups", script="update_groups.py",
+        sources=[SourceSpec(TUTORS_SRC, "Tutors", cols=[0, 1, 2, 21, 4])],
+        dest=DestSpec(RATING_DST, "Tutors"),
+        ncols=5, key_cols=[0],    # tutor id
+    ),
+    JobSpec(
+        name="update_groups_NEW", script="update_groups_NEW.py",
+        sources=[SourceSpec("1UIQWBvwGDWpUeCm1ob-ZonRDsju2e-sL1gB5oLAzSR8", "Groups & Teachers", cols=[0, 1, 9, 3])],
+        dest=DestSpec(RATING_DST, "Groups"),
+        ncols=4,
+    ),
+    JobSpec(
+        name="update_students_in_groups", script="update_students_in_groups.py",
+        sources=[SourceSpec("1XwyahhHC7uVzwfoErrvwrcruEjwewqIUp2u-6nvdSR0", "data", cols=[1, 13, 14, 3],
+                            method="get_all_values",
+                            filters=[RowFilter(col=1, regex="COL|CHI|ESP")])],
+        dest=DestSpec(RATING_DST, "Students", clear_range="A:D", compact=True),
+        ncols=4, adaptive=True, max_interval=4 * 60,   # свой cron выключен — опрашивает sync-tick
+    ),
+    JobSpec(
+        name="update_tutors", script="update_tutors.py",
+        sources=[SourceSpec(TUTORS_SRC, "Tutors", cols=[0, 1, 2, 21, 4, 15, 16])],
+        dest=DestSpec(RATING_DST, "Tutors", clear_range="A:G"),
+        ncols=7, key_cols=[0],    # tutor id
+    ),
+]
+
+DERIVED = [
+    DerivedSpec(
+        # Заголовки — строка 1 источников, как их хранит снапшот CDC:
+        #   QA-update — "All lesson reviews OLD" C, D, O, M, F (архивы приводятся к ним): D — tutor id, O — оценка, F — группа;
+        #   update_tutors — "Tutors" в TUTORS_SRC, A — tutor id, B — имя.
+        # Тексты заголовков с живыми листами не сверены: build падает со списком настоящих,
+        # поэтому publish выключен, пока `sync_jobs.py derive qa-by-tutor` не соберёт результат без ошибок.
+        name="qa-by-tutor", left="QA-update", right="update_tutors",
+        left_on="Tutor ID", right_on="Tutor ID", right_cols=["Tutor Name"],
+        group_by=["Tutor ID", "Tutor Name"],
+        aggregates=[Aggregate("Evaluations", "count"), Aggregate("Avg score", "mean", col="Score"),
+                    Aggregate("Groups", "nunique", col="Group")],
+        dest=DestSpec(RATING_DST, "QA by tutor"),
+    ),
+]
+
+_CRON_RE = re.compile(r'^(\s*#?\s*)-\s*cron:\s*"([^"]+)"')
+_RUN_RE = re.compile(r'python\s+([\w\-]+\.py)')
+
+
+def load_workflow_schedules(workflows_dir=WORKFLOWS_DIR):
+    """
+    {script: [{"cron": "...", "enabled": bool, "workflow": "..."}]}.
+    Закомментированный cron считаем выключенным расписанием.
+    """
+    result = {}
+    for path in sorted(glob.glob(os.path.join(workflows_dir, "*.yml"))):
+        with open(path, encoding="utf-8") as f:
+            text = f.read()
+        scripts = _RUN_RE.findall(text)
+        crons = []
+        for line in text.splitlines():
+            m = _CRON_RE.match(line)
+            if m:
+                crons.append({"cron": m.group(2), "enabled": "#" not in m.group(1),
+                              "workflow": os.path.basename(path)})
+        for script in scripts:
+            result.setdefault(script, []).extend(crons)
+    return result
+
+
+def dest_key(job):
+    return (job.dest.ss_id, job.dest.sheet)
+
+
+def _col_bounds(ref, default):
+    m = re.match(r"([A-Z]*)(\d*)$", ref)
+    letters, digits = m.group(1), m.group(2)
+    col = a1_to_rowcol(f"{letters}1")[1] if letters else default[0]
+    row = int(digits) if digits else default[1]
+    return col, row
+
+
+def write_area(job):
+    """
+    (row1, row2, col1, col2): очищаемый диапазон плюс область записи (колонки 1..ncols со start_row).
+    Запись всегда идёт с колонки 1 и до конца листа по строкам, поэтому из clear_range
+    важны только верхняя строка и правая колонка; правая колонка без буквы — до конца листа.
+    """
+    dst = job.dest
+    if dst.clear_range is None:
+        return (1, MAX_ROWS, 1, MAX_COLS)  # ws.clear() — весь лист
+    start, _, end = dst.clear_range.partition(":")
+    r1 = _col_bounds(start, (1, 1))[1]
+    c2 = _col_bounds(end or start, (MAX_COLS, MAX_ROWS))[0]
+    return (min(r1, dst.start_row), MAX_ROWS, 1, max(c2, job.ncols))
+
+
+def find_overlaps(jobs):
+    """Пары джобов, которые пишут в пересекающиеся области одного листа (проверяется при регистрации)."""
+    overlaps = []
+    for i, a in enumerate(jobs):
+        for b in jobs[i + 1:]:
+            if dest_key(a) != dest_key(b):
+                continue
+            ra, rb = write_area(a), write_area(b)
+            if ra[0] <= rb[1] and rb[0] <= ra[1] and ra[2] <= rb[3] and rb[2] <= ra[3]:
+                overlaps.append((a, b))
+                logging.warning(f"⚠ {a.name} and {b.name} write overlapping ranges of '{a.dest.sheet}' "
+                                f"({a.dest.clear_range or 'whole sheet'} vs {b.dest.clear_range or 'whole sheet'})")
+    return overlaps
+
+
+def get_jobs(names=None):
+    schedules = load_workflow_schedules()
+    jobs = []
+    for job in JOBS:
+        if names and job.name not in names:
+            continue
+        job.schedules = schedules.get(job.script, [])
+        jobs.append(job)
+    unknown = set(names or []) - {j.name for j in jobs}
+    if unknown:
+        raise SystemExit(f"❌ Unknown jobs: {', '.join(sorted(unknown))}")
+    find_overlaps(jobs)
+    return jobs
+
+
+
+def get_job(name):
+    return get_jobs([name])[0]
+
+
+def get_derived(names=None):
+    derived = [d for d in DERIVED if not names or d.name in names]
+    unknown = set(names or []) - {d.name for d in derived}
+    if unknown:
+        raise SystemExit(f"❌ Unknown derived stages: {', '.join(sorted(unknown))}")
+    return derived
+
+
+def load_script(script):
+    """Импорт скрипта по имени файла (у части скриптов в имени дефис, обычный import не подходит)."""
+    path = os.path.join(REPO_DIR, script)
+    module_name = os.path.splitext(script)[0].replace("-", "_")
+    spec = importlib.util.spec_from_file_location(module_name, path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def main(argv=None):
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s [%(threadName)s] %(message)s")
+    parser = argparse.ArgumentParser(description="Google Sheets sync jobs")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    p_plan = sub.add_parser("plan", help="dry-run: API calls, cells and quota forecast, nothing is changed")
+    p_plan.add_argument("jobs", nargs="*", help="job names (default: all)")
+    p_plan.add_argument("--include-disabled", action="store_true",
+                        help="also project commented-out cron schedules")
+
+    p_run = sub.add_parser("run", help="run jobs concurrently with per-destination locks")
+    p_run.add_argument("jobs", nargs="*", help="job names (default: all)")
+    p_run.add_argument("--parallel", type=int, default=None, help="max jobs at once (default: SYNC_PARALLEL or 4)")
+    p_run.add_argument("--profile", action="store_true",
+                       help="sample each job and write speedscope/folded/tracemalloc reports (see sync_profile)")
+
+    p_derive = sub.add_parser("derive", help="rebuild local join/aggregate tabs from the last job outputs")
+    p_derive.add_argument("names", nargs="*", help="derived stage names (default: all)")
+    p_derive.add_argument("--publish", action="store_true",
+                          help="write the tabs even for stages with publish=False (default: only build and log)")
+
+    p_tick = sub.add_parser("tick", help="run jobs whose adaptive polling interval is due and whose sources changed")
+    p_tick.add_argument("jobs", nargs="*", help="job names (default: jobs with adaptive=True)")
+    p_tick.add_argument("--parallel", type=int, default=None)
+    p_tick.add_argument("--dry-run", action="store_true", help="only show what is due and changed")
+
+    p_fresh = sub.add_parser("freshness", help="staleness/lag percentiles against per-job targets, writes the metrics file")
+    p_fresh.add_argument("jobs", nargs="*", help="job names (default: all)")
+
+    args = parser.parse_args(argv)
+
+    if args.command == "plan":
+        from sync_plan import run_plan
+        return run_plan(get_jobs(args.jobs), include_disabled=args.include_disabled)
+
+    if args.command == "run":
+        from sync_runner import run_jobs, DEFAULT_PARALLEL
+        return run_jobs(get_jobs(args.jobs), parallel=args.parallel or DEFAULT_PARALLEL, profile=args.profile)
+
+    if args.command == "tick":
+        from sync_schedule import tick
+        jobs = get_jobs(args.jobs) if args.jobs else [job for job in get_jobs() if job.adaptive]
+        return tick(jobs, parallel=args.parallel, dry_run=args.dry_run)
+
+    if args.command == "freshness":
+        from sync_freshness import report
+        return 1 if report(get_jobs(args.jobs)) else 0
+
+    if args.command == "derive":
+        from sync_derive import run_derived
+        return run_derived(get_derived(args.names), force_publish=args.publish)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
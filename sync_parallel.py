@@ -0,0 +1,21 @@
+#!/usr/bin/env python3
+"""
+Хэши строк и дедупликация для sync_spill / sync_cdc / sync_store / sync_derive.
+
+Пула процессов здесь нет: хэширование строк (hash_pandas_object) само по
+себе стоит столько же, сколько весь df.duplicated, а отдать воркерам кадр
+без копирования нельзя — по замерам на 0.4–2M строк любой параллельный
+вариант медленнее serial. Вернуть пул имеет смысл только вместе с
+бенчмарком (bench_transforms.py), который покажет выигрыш.
+"""
+import pandas as pd
+
+
+def hash_rows(df, as_str=True):
+    """hash_pandas_object(df.astype(str)) построчно (uint64); as_str=False — без приведения к строкам."""
+    return pd.util.hash_pandas_object(df.astype(str) if as_str else df, index=False).to_numpy()
+
+
+def duplicated(df, subset=None, keep="first"):
+    """df.duplicated(subset, keep) как numpy-массив флагов."""
+    return df.duplicated(subset=subset, keep=keep).to_numpy()
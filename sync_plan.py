@@ -0,0 +1,240 @@
+#!/usr/bin/env python3
+"""
+Dry-run планировщик: по метаданным таблиц считает, какие вызовы API сделает
+каждый джоб, сколько ячеек/байт прочитает и запишет, и сравнивает это с
+минутными/суточными квотами. Ничего не пишет и не читает сами данные.
+"""
+import os
+import math
+import logging
+from dataclasses import dataclass
+
+from sheets_io import (
+    Deadline, authorize, api_retry_open, read_call, READS_PER_MINUTE, WRITES_PER_MINUTE,
+    GRID_HEADROOM, CELL_LIMIT, CELL_WARN_SHARE,
+)
+from sync_strategies import SHARD_ROWS, shard_ranges
+from sync_spill import CHUNK_ROWS
+
+# —————————————————————————————
+CELL_BYTES     = int(os.environ.get("PLAN_CELL_BYTES", "24"))     # ~JSON-байт на ячейку
+READS_PER_DAY  = int(os.environ.get("SHEETS_READS_PER_DAY", "0"))  # 0 = без суточного лимита
+WRITES_PER_DAY = int(os.environ.get("SHEETS_WRITES_PER_DAY", "0"))
+# —————————————————————————————
+
+
+@dataclass
+class Call:
+    kind: str        # "read" | "write" | "drive" (не Sheets-квота)
+    op: str
+    target: str
+    cells: int = 0
+    note: str = ""
+
+    @property
+    def bytes(self):
+        return self.cells * CELL_BYTES
+
+
+class GridCache:
+    """Метаданные листов (rowCount/columnCount) — по одному запросу на таблицу."""
+
+    def __init__(self, client, deadline):
+        self.client = client
+        self.deadline = deadline
+        self.sheets = {}
+        self.requests = 0
+        self.compacted = {}       # (ss_id, вкладка) → rowCount после compact-записи
+
+    def grid(self, ss_id, title=None, gid=None):
+        if ss_id not in self.sheets:
+            sh = api_retry_open(self.client, ss_id, self.deadline)
+            worksheets = read_call(sh.worksheets, f"worksheets:{ss_id}", self.deadline, sh.client)
+            self.requests += 2
+            self.sheets[ss_id] = {ws.title: (ws.id, ws.row_count, ws.col_count) for ws in worksheets}
+        for ws_title, (ws_id, rows, cols) in self.sheets[ss_id].items():
+            if ws_title == title or (gid is not None and ws_id == gid):
+                return rows, cols
+        raise LookupError(f"sheet {title or gid} not found in {ss_id}")
+
+
+def plan_job(job, grids):
+    """Список вызовов одного прогона джоба в том порядке, как их делает скрипт."""
+    calls = [Call("drive", "files.get", f"{len(job.sources)} source(s), batched",
+                  note="run stops here if no source version changed")]
+    rows_out = 0
+    for src in job.sources:
+        target = f"{src.ss_id[:8]}…/{src.sheet or src.gid}"
+        rows, cols = grids.grid(src.ss_id, src.sheet, src.gid)
+        calls.append(Call("read", "open_by_key", target))
+        calls.append(Call("read", "worksheet", target))
+        if src.method == "get_all_values":
+            calls.append(Call("read", "get_all_values", target, rows * cols, "≤ grid size"))
+        elif rows > SHARD_ROWS:
+            shards = shard_ranges(rows)
+            for start, end in shards:
+                calls.append(Call("read", "batch_get", target, (end - start + 1) * len(src.cols),
+                                  f"shard rows {start}-{end} of {len(shards)}, in parallel"))
+        else:
+            calls.append(Call("read", "batch_get", target, rows * len(src.cols),
+                              f"{len(src.cols)} column ranges, ≤ grid rows"))
+        rows_out += max(0, rows - 1)
+
+    dst = job.dest
+    target = f"{dst.ss_id[:8]}…/{dst.sheet}"
+    dst_rows, dst_cols = grids.grid(dst.ss_id, dst.sheet)
+    calls.append(Call("read", "open_by_key", target))
+    calls.append(Call("read", "worksheet", target))
+    if dst.clear_range:
+        calls.append(Call("write", "batch_clear", target, note=dst.clear_range))
+    else:
+        calls.append(Call("write", "clear", target, dst_rows * dst_cols, "whole sheet"))
+
+    need_rows = dst.start_row - 1 + rows_out + (1 if dst.header else 0)
+    rows_written = rows_out + (1 if dst.header else 0)
+    tail_check = []
+    if dst.compact and need_rows + GRID_HEADROOM < dst_rows:
+        tail_check.append(Call("read", "values_get", target, (dst_rows - need_rows - GRID_HEADROOM) * dst_cols,
+                               "rows to drop must be empty before shrinking"))
+    if dst.compact and not dst.chunked:
+        calls.extend(tail_check)
+        grids.compacted[(dst.ss_id, dst.sheet)] = need_rows + GRID_HEADROOM
+        calls.append(Call("write", "batch_update", target, rows_written * job.ncols,
+                          f"grid {dst_rows}→{need_rows + GRID_HEADROOM} rows + write, one call"))
+        return calls
+    if dst.chunked:
+        # куски только если дедупликация ушла на диск — оценка сверху
+        chunks = max(1, math.ceil(rows_written / CHUNK_ROWS))
+        for i in range(chunks):
+            end = dst.start_row - 1 + min((i + 1) * CHUNK_ROWS, rows_written)
+            if end > dst_rows:
+                calls.append(Call("write", "resize", target, note=f"grid grows to {end} rows for the chunk"))
+            calls.append(Call("write", "values_update", target,
+                              min(CHUNK_ROWS, rows_written - i * CHUNK_ROWS) * job.ncols, f"chunk {i + 1} of ≤{chunks}"))
+        if dst.compact:
+            calls.extend(tail_check)
+            grids.compacted[(dst.ss_id, dst.sheet)] = need_rows + GRID_HEADROOM
+            calls.append(Call("write", "batch_update", target, note=f"grid {dst_rows}→{need_rows + GRID_HEADROOM} rows"))
+        return calls
+    if need_rows > dst_rows or job.ncols > dst_cols:
+        calls.append(Call("write", "resize", target, note=f"{dst_rows}→{need_rows} rows"))
+    calls.append(Call("write", "values_update", target, rows_written * job.ncols, "RAW or USER_ENTERED"))
+    return calls
+
+
+def summarize(calls):
+    reads = [c for c in calls if c.kind == "read"]
+    writes = [c for c in calls if c.kind == "write"]
+    return {
+        "reads": len(reads),
+        "writes": len(writes),
+        "cells_read": sum(c.cells for c in reads),
+        "cells_written": sum(c.cells for c in writes if c.op in ("values_update", "batch_update")),
+        "bytes_read": sum(c.bytes for c in reads),
+        "bytes_written": sum(c.bytes for c in writes if c.op in ("values_update", "batch_update")),
+    }
+
+
+def _cron_field(expr, lo, hi):
+    values = set()
+    for part in expr.split(","):
+        step = 1
+        if "/" in part:
+            part, step = part.split("/")
+            step = int(step)
+        if part == "*":
+            start, end = lo, hi
+        elif "-" in part:
+            start, end = (int(x) for x in part.split("-"))
+        else:
+            start = int(part)
+            end = hi if step > 1 else start
+        values.update(range(start, end + 1, step))
+    return values
+
+
+def cron_minutes_of_day(cron):
+    """Минуты суток (0..1439), в которые стартует cron. День/месяц/день недели не учитываем."""
+    minute, hour = cron.split()[:2]
+    return sorted(h * 60 + m for h in _cron_field(hour, 0, 23) for m in _cron_field(minute, 0, 59))
+
+
+def project_schedule(jobs, per_job, include_disabled=False):
+    """Нагрузка по минутам суток: сколько запросов приходит в одну минуту от всех джобов."""
+    slots = {}
+    daily = {"reads": 0, "writes": 0}
+    for job in jobs:
+        for sched in job.schedules:
+            if not sched["enabled"] and not include_disabled:
+                continue
+            s = per_job[job.name]
+            for minute in cron_minutes_of_day(sched["cron"]):
+                slot = slots.setdefault(minute, {"jobs": [], "reads": 0, "writes": 0})
+                slot["jobs"].append(job.name)
+                slot["reads"] += s["reads"]
+                slot["writes"] += s["writes"]
+                daily["reads"] += s["reads"]
+                daily["writes"] += s["writes"]
+    return slots, daily
+
+
+def print_cell_usage(jobs, grids):
+    """Ячейки сетки по целевым таблицам (все вкладки) против лимита 10M — сейчас и после compact-записей."""
+    print(f"\n== Destination cell usage (limit {CELL_LIMIT:,} per spreadsheet)")
+    for ss_id in sorted({job.dest.ss_id for job in jobs} & set(grids.sheets)):
+        tabs = grids.sheets[ss_id]
+        now = sum(rows * cols for _, rows, cols in tabs.values())
+        after = sum(grids.compacted.get((ss_id, title), rows) * cols for title, (_, rows, cols) in tabs.items())
+        flag = "⚠" if max(now, after) >= CELL_WARN_SHARE * CELL_LIMIT else " "
+        largest = max(tabs.items(), key=lambda t: t[1][1] * t[1][2])
+        print(f"  {flag} {ss_id[:8]}…  {now:>12,} cells ({now / CELL_LIMIT:>6.1%})  after compact {after:>12,} "
+              f"({after / CELL_LIMIT:>6.1%})  largest '{largest[0]}' {largest[1][1]}x{largest[1][2]}")
+
+
+def run_plan(jobs, include_disabled=False):
+    deadline = Deadline.from_env("plan")
+    client = authorize()
+    grids = GridCache(client, deadline)
+
+    per_job = {}
+    total = []
+    for job in jobs:
+        try:
+            calls = plan_job(job, grids)
+        except LookupError as e:
+            logging.error(f"{job.name}: {e}")
+            continue
+        per_job[job.name] = summarize(calls)
+        total.extend(calls)
+
+        print(f"\n== {job.name} ({job.script})")
+        for c in calls:
+            cells = f"{c.cells:>10,} cells" if c.cells else " " * 16
+            print(f"  {c.kind:<5} {c.op:<15} {c.target:<45} {cells}  {c.note}")
+        s = per_job[job.name]
+        print(f"  → {s['reads']} reads, {s['writes']} writes, "
+              f"{s['cells_read']:,} cells read (~{s['bytes_read'] / 1e6:.1f} MB), "
+              f"{s['cells_written']:,} cells written (~{s['bytes_written'] / 1e6:.1f} MB)")
+
+    t = summarize(total)
+    print(f"\n== Total for one run of {len(per_job)} jobs "
+          f"(+{grids.requests} metadata reads made by this plan)")
+    print(f"  reads  {t['reads']:>5} / {READS_PER_MINUTE} per minute")
+    print(f"  writes {t['writes']:>5} / {WRITES_PER_MINUTE} per minute")
+    print(f"  cells  {t['cells_read']:,} read, {t['cells_written']:,} written")
+
+    print_cell_usage(jobs, grids)
+
+    slots, daily = project_schedule(jobs, per_job, include_disabled)
+    print(f"\n== Cron projection ({'incl. disabled' if include_disabled else 'enabled only'}), per day")
+    print(f"  reads  {daily['reads']:>6}" + (f" / {READS_PER_DAY}" if READS_PER_DAY else ""))
+    print(f"  writes {daily['writes']:>6}" + (f" / {WRITES_PER_DAY}" if WRITES_PER_DAY else ""))
+    hot = [(m, s) for m, s in sorted(slots.items()) if len(s["jobs"]) > 1
+           or s["reads"] > READS_PER_MINUTE or s["writes"] > WRITES_PER_MINUTE]
+    for minute, s in hot:
+        flag = "⚠ over quota" if s["reads"] > READS_PER_MINUTE or s["writes"] > WRITES_PER_MINUTE else ""
+        print(f"  {minute // 60:02d}:{minute % 60:02d}  {len(s['jobs'])} jobs, "
+              f"{s['reads']} reads, {s['writes']} writes  {flag}  [{', '.join(s['jobs'])}]")
+    if not hot:
+        print("  no overlapping starts")
+    return 0
@@ -0,0 +1,246 @@
+#!/usr/bin/env python3
+"""
+Профилирование джоба без правки скриптов: `sync_jobs.py run --profile` или
+SYNC_PROFILE=1 при прямом запуске скрипта.
+
+Сэмплирующий профилировщик (поток раз в SYNC_PROFILE_INTERVAL снимает стек
+потока джоба и потоков пулов, которые сейчас работают на него, — задачи
+пулов оборачиваются в attach) + tracemalloc. Стеки потоков пулов начинаются
+с псевдо-кадра «thread <имя>»; их время идёт параллельно ожиданию в потоке
+джоба, поэтому сумма весов может быть больше wall. На каждый прогон пишет в STATE_DIR/profiles:
+
+    <job>-<UTC timestamp>.speedscope.json   — открыть на https://www.speedscope.app
+    <job>-<UTC timestamp>.folded            — для flamegraph.pl
+    <job>-<UTC timestamp>.memory.txt        — пик памяти и топ мест аллокаций
+
+tracemalloc общий на процесс: при параллельном run аллокации соседних
+джобов попадают в отчёт тоже — для чистых цифр профилируйте с --parallel 1.
+"""
+import os
+import sys
+import json
+import time
+import logging
+import threading
+import tracemalloc
+from collections import Counter
+from contextlib import contextmanager
+from datetime import datetime, timezone
+
+from sheets_io import STATE_DIR
+
+# —————————————————————————————
+PROFILE_DIR      = os.path.join(STATE_DIR, "profiles")
+ENABLED          = os.environ.get("SYNC_PROFILE", "0") == "1"
+SAMPLE_INTERVAL  = float(os.environ.get("SYNC_PROFILE_INTERVAL", "0.005"))   # сек
+TRACE_FRAMES     = int(os.environ.get("SYNC_PROFILE_TRACE_FRAMES", "15"))
+TOP_ALLOCATIONS  = 30
+TOP_FUNCTIONS    = 15
+# —————————————————————————————
+
+_inputs = {}          # thread id → {"rows": ..., "sources": ...}
+_inputs_lock = threading.Lock()
+_trace_users = 0
+_trace_lock = threading.Lock()
+_sampled = {}         # thread id → Sampler джоба, на который поток сейчас работает
+
+
+def note_input(rows):
+    """Размер входа (строки источников до фильтра) — вызывается из sync_filters при чтении."""
+    with _inputs_lock:
+        info = _inputs.get(threading.get_ident())
+        if info is not None:
+            info["rows"] += rows
+            info["sources"] += 1
+
+
+class Sampler(threading.Thread):
+    """Раз в interval снимает стеки потока thread_id и подключённых потоков через sys._current_frames()."""
+
+    def __init__(self, thread_id, interval=SAMPLE_INTERVAL):
+        super().__init__(name="profiler", daemon=True)
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = Counter()
+        self.samples = 0
+        self._workers = {}        # thread id → имя потока пула
+        self._workers_lock = threading.Lock()
+        self._done = threading.Event()
+
+    def add_worker(self, thread_id, name):
+        with self._workers_lock:
+            self._workers[thread_id] = name
+
+    def remove_worker(self, thread_id):
+        with self._workers_lock:
+            self._workers.pop(thread_id, None)
+
+    def run(self):
+        while not self._done.wait(self.interval):
+            frames = sys._current_frames()
+            with self._workers_lock:
+                threads = [(self.thread_id, None), *self._workers.items()]
+            for thread_id, name in threads:
+                frame = frames.get(thread_id)
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append((code.co_name, code.co_filename, code.co_firstlineno))
+                    frame = frame.f_back
+                if name is not None:
+                    stack.append((f"thread {name}", "<thread>", 0))
+                if stack:
+                    self.stacks[tuple(reversed(stack))] += 1
+                    self.samples += 1
+
+    def stop(self):
+        self._done.set()
+        self.join()
+
+
+def attach(fn):
+    """
+    fn для отправки в пул потоков из профилируемого джоба: пока fn работает,
+    её поток сэмплируется вместе с потоком джоба. Вне профилирования — fn как есть.
+    """
+    sampler = _sampled.get(threading.get_ident())
+    if sampler is None:
+        return fn
+
+    def run(*args, **kwargs):
+        ident = threading.get_ident()
+        sampler.add_worker(ident, threading.current_thread().name)
+        _sampled[ident] = sampler      # вложенные пулы (шарды внутри стратегии) тоже подключатся
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            _sampled.pop(ident, None)
+            sampler.remove_worker(ident)
+    return run
+
+
+def _frame_name(frame):
+    name, filename, line = frame
+    return f"{name} ({os.path.basename(filename)}:{line})"
+
+
+def to_speedscope(stacks, name, interval):
+    frames, index = [], {}
+    samples, weights = [], []
+    for stack, count in stacks.items():
+        ids = []
+        for frame in stack:
+            if frame not in index:
+                index[frame] = len(frames)
+                frames.append({"name": frame[0], "file": frame[1], "line": frame[2]})
+            ids.append(index[frame])
+        samples.append(ids)
+        weights.append(count * interval)
+    return {
+        "$schema": "https://www.speedscope.app/file-format-schema.json",
+        "name": name,
+        "exporter": "sync_profile",
+        "shared": {"frames": frames},
+        "profiles": [{
+            "type": "sampled", "name": name, "unit": "seconds",
+            "startValue": 0, "endValue": sum(weights),
+            "samples": samples, "weights": weights,
+        }],
+    }
+
+
+def to_folded(stacks):
+    return "".join(";".join(_frame_name(f) for f in stack) + f" {count}\n" for stack, count in stacks.items())
+
+
+def top_functions(stacks, n=TOP_FUNCTIONS):
+    """(доля inclusive, доля self, функция) — куда ушло время: сеть, транспонирование, dedupe, payload."""
+    inclusive, own = Counter(), Counter()
+    total = sum(stacks.values()) or 1
+    for stack, count in stacks.items():
+        for frame in set(stack):
+            inclusive[frame] += count
+        own[stack[-1]] += count
+    return [(inclusive[f] / total, own[f] / total, _frame_name(f)) for f, _ in inclusive.most_common(n)]
+
+
+def _start_trace():
+    global _trace_users
+    with _trace_lock:
+        if _trace_users == 0:
+            tracemalloc.start(TRACE_FRAMES)
+        else:
+            tracemalloc.reset_peak()
+        _trace_users += 1
+
+
+def _stop_trace():
+    global _trace_users
+    snapshot = tracemalloc.take_snapshot()
+    _, peak = tracemalloc.get_traced_memory()
+    with _trace_lock:
+        _trace_users -= 1
+        if _trace_users == 0:
+            tracemalloc.stop()
+    return snapshot, peak
+
+
+def _memory_report(job, tags, snapshot, peak):
+    snapshot = snapshot.filter_traces([
+        tracemalloc.Filter(False, tracemalloc.__file__),
+        tracemalloc.Filter(False, __file__),
+    ])
+    lines = [f"job: {job}", *(f"{k}: {v}" for k, v in tags.items()),
+             f"peak: {peak / 2**20:.1f} MB", "", f"top {TOP_ALLOCATIONS} allocation sites (live at end of job):"]
+    for stat in snapshot.statistics("traceback")[:TOP_ALLOCATIONS]:
+        lines.append(f"{stat.size / 2**20:9.2f} MB  {stat.count:>9} blocks")
+        lines.extend(f"    {line}" for line in stat.traceback.format(limit=4))
+    return "\n".join(lines) + "\n"
+
+
+@contextmanager
+def profile_job(job, enabled=None):
+    """Оборачивает прогон main() джоба; без SYNC_PROFILE=1 (или enabled=True) ничего не делает."""
+    if not (ENABLED if enabled is None else enabled):
+        yield
+        return
+
+    ident = threading.get_ident()
+    with _inputs_lock:
+        _inputs[ident] = {"rows": 0, "sources": 0}
+    _start_trace()
+    sampler = Sampler(ident)
+    _sampled[ident] = sampler
+    started = time.monotonic()
+    sampler.start()
+    try:
+        yield
+    finally:
+        _sampled.pop(ident, None)
+        sampler.stop()
+        wall = time.monotonic() - started
+        snapshot, peak = _stop_trace()
+        with _inputs_lock:
+            info = _inputs.pop(ident)
+        tags = {"input_rows": info["rows"], "input_sources": info["sources"],
+                "wall_seconds": round(wall, 2), "samples": sampler.samples}
+        _write_reports(job, tags, sampler, snapshot, peak)
+
+
+def _write_reports(job, tags, sampler, snapshot, peak):
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    stamp = datetime.now(timezone.utc).strftime("%Y%m%dT%H%M%S%fZ")
+    base = os.path.join(PROFILE_DIR, f"{job}-{stamp}")
+    title = f"{job} rows={tags['input_rows']} wall={tags['wall_seconds']}s"
+
+    with open(base + ".speedscope.json", "w", encoding="utf-8") as f:
+        json.dump(to_speedscope(sampler.stacks, title, sampler.interval), f)
+    with open(base + ".folded", "w", encoding="utf-8") as f:
+        f.write(to_folded(sampler.stacks))
+    with open(base + ".memory.txt", "w", encoding="utf-8") as f:
+        f.write(_memory_report(job, tags, snapshot, peak))
+
+    logging.info(f"✔ Profile {job}: {tags['input_rows']} input rows, {tags['wall_seconds']}s, "
+                 f"peak {peak / 2**20:.1f} MB → {base}.*")
+    for incl, own, name in top_functions(sampler.stacks):
+        logging.info(f"    {incl:6.1%} incl {own:6.1%} self  {name}")
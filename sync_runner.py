@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+"""
+Параллельный запуск джобов с блокировкой на каждый целевой лист.
+
+Джобы с общим целевым листом (пересечения областей записи sync_jobs
+находит ещё при загрузке реестра) выстраиваются в цепочку и идут по очереди,
+остальные — параллельно (не больше --parallel одновременно). Кроме того,
+на лист берётся flock-файл в STATE_DIR/locks (sheets_io.destination_lock),
+чтобы не пересечься с другим процессом на той же машине; скрипты берут тот же
+lock вокруг очистки и записи и при запуске напрямую.
+"""
+import os
+import time
+import logging
+import threading
+import traceback
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor
+
+from sheets_io import authorize, get_pool, destination_lock
+from sync_jobs import load_script, dest_key, get_derived
+from sync_versions import drive_versions
+from sync_profile import profile_job
+from sync_freshness import report as report_freshness
+
+# —————————————————————————————
+DEFAULT_PARALLEL  = int(os.environ.get("SYNC_PARALLEL", "4"))
+# —————————————————————————————
+
+
+def _run_job(job, profile=False):
+    threading.current_thread().name = job.name
+    started = time.monotonic()
+    try:
+        with destination_lock(*dest_key(job)):
+            logging.info(f"▶ {job.name} ({job.script})")
+            with profile_job(job.name, enabled=profile or None):
+                load_script(job.script).main()
+        return {"job": job.name, "ok": True, "seconds": time.monotonic() - started}
+    except BaseException as e:  # SystemExit из скриптов тоже считаем падением джоба
+        if isinstance(e, KeyboardInterrupt):
+            raise
+        if isinstance(e, SystemExit) and e.code in (0, None):
+            return {"job": job.name, "ok": True, "seconds": time.monotonic() - started}
+        logging.error(f"✖ {job.name} failed: {e}\n{traceback.format_exc()}")
+        return {"job": job.name, "ok": False, "seconds": time.monotonic() - started, "error": str(e)}
+
+
+def _run_chain(chain, profile=False):
+    return [_run_job(job, profile) for job in chain]
+
+
+def run_jobs(jobs, parallel=DEFAULT_PARALLEL, profile=False, results=None):
+    """Код возврата 0/1; results (список) дополняется {"job", "ok", "seconds"} по каждому джобу."""
+    # один Drive batch на все источники — скрипты дальше берут версии из кэша
+    try:
+        drive_versions(authorize(), sorted({src.ss_id for job in jobs for src in job.sources}))
+    except Exception as e:
+        logging.warning(f"Drive version pre-check failed ({e}), every job will fetch its sources")
+
+    # с пулом аккаунтов — проверка доступа всех аккаунтов ко всем таблицам до старта джобов
+    pool = get_pool()
+    if pool is not None:
+        dests = {job.dest.ss_id for job in jobs}
+        try:
+            pool.check_access(sorted({src.ss_id for job in jobs for src in job.sources} | dests), dests)
+        except Exception as e:
+            logging.warning(f"Service-account access check failed ({e}), accounts will be tried on open")
+
+    chains = {}
+    for job in jobs:
+        chains.setdefault(dest_key(job), []).append(job)
+
+    started = time.monotonic()
+    with ThreadPoolExecutor(max_workers=max(1, parallel), thread_name_prefix="job") as executor:
+        run_results = [r for chain_results in executor.map(partial(_run_chain, profile=profile), chains.values())
+                   for r in chain_results]
+    wall = time.monotonic() - started
+    if results is not None:
+        results.extend(run_results)
+    results = run_results
+
+    # локальные join/агрегаты — если хотя бы один вход прогнался и ни один не упал
+    ok = {r["job"] for r in results if r["ok"]}
+    failed = {r["job"] for r in results if not r["ok"]}
+    derived = [d for d in get_derived() if {d.left, d.right} & ok and not {d.left, d.right} & failed]
+    derived_rc = 0
+    if derived:
+        from sync_derive import run_derived
+        derived_rc = run_derived(derived)
+
+    print(f"\n== Run summary ({len(jobs)} jobs, parallel={parallel})")
+    for r in results:
+        status = "✔" if r["ok"] else "✖"
+        print(f"  {status} {r['job']:<28} {r['seconds']:>7.1f}s  {r.get('error', '')}")
+    print(f"  wall {wall:.1f}s, sum of job times {sum(r['seconds'] for r in results):.1f}s")
+    if pool is not None:
+        print(f"  quota headroom: {pool.summary()}")
+    if derived:
+        print(f"  derived stages: {', '.join(d.name for d in derived)} {'✔' if derived_rc == 0 else '✖'}")
+    report_freshness(jobs)
+    return 0 if all(r["ok"] for r in results) and derived_rc == 0 else 1
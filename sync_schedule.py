@@ -0,0 +1,131 @@
+#!/usr/bin/env python3
+"""
+Адаптивный опрос источников вместо фиксированного cron на каждый джоб.
+
+Workflow sync-tick запускает `sync_jobs.py tick` часто (раз в 15 минут).
+Опрашиваются только джобы с JobSpec.adaptive=True — остальные по-прежнему
+идут по своим workflow (или выключены). Tick берёт джобы, у которых подошёл
+срок, одним Drive batch сверяет версии источников и запускает только изменившиеся. Интервал опроса джоба
+подстраивается под частоту изменений в границах JobSpec.min_interval и
+max_interval (минуты): источник изменился и прогон прошёл — интервал × SPEEDUP,
+простаивает — интервал × BACKOFF; упавший прогон интервал не меняет и
+повторяется через min_interval. Если не удалась сама сверка версий в Drive,
+джобы всё равно запускаются (изменение не теряем), но интервал остаётся прежним:
+неизвестно, менялся ли источник. Горячие источники опрашиваются чаще, холодные реже,
+суммарно квоты уходит не больше.
+
+    .sync_state/schedule.json
+"""
+import os
+import json
+import time
+import logging
+
+from sheets_io import STATE_DIR, authorize
+from sync_versions import drive_versions, sources_unchanged, observe_staleness
+from sync_freshness import report as report_freshness
+
+# —————————————————————————————
+SCHEDULE_PATH = os.path.join(STATE_DIR, "schedule.json")
+SPEEDUP       = float(os.environ.get("SCHEDULE_SPEEDUP", "0.5"))
+BACKOFF       = float(os.environ.get("SCHEDULE_BACKOFF", "1.5"))
+HISTORY_LEN   = 50
+# —————————————————————————————
+
+
+def load_state():
+    try:
+        with open(SCHEDULE_PATH, encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_state(state):
+    os.makedirs(os.path.dirname(SCHEDULE_PATH) or ".", exist_ok=True)
+    tmp = SCHEDULE_PATH + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(state, f, indent=1, sort_keys=True)
+    os.replace(tmp, SCHEDULE_PATH)
+
+
+def _entry(state, job):
+    return state.setdefault(job.name, {
+        "interval": job.min_interval, "next_due": 0, "polls": 0, "changes": 0, "history": [],
+    })
+
+
+def is_due(state, job, now):
+    return _entry(state, job)["next_due"] <= now
+
+
+def record_poll(state, job, changed, now, failed=False):
+    """Учитываем результат опроса и пересчитываем интервал в границах джоба; changed=None — версия неизвестна."""
+    e = _entry(state, job)
+    e["last_poll"] = now
+    if failed:
+        # изменение не доставлено — интервал не трогаем, пробуем снова через min_interval
+        e["next_due"] = now + job.min_interval * 60
+        e["failures"] = e.get("failures", 0) + 1
+        return e
+    if changed is None:
+        # сверка версий не удалась — ни ускорять, ни замедлять не на чем
+        e["next_due"] = now + e["interval"] * 60
+        e["unknown_polls"] = e.get("unknown_polls", 0) + 1
+        return e
+    factor = SPEEDUP if changed else BACKOFF
+    e["interval"] = round(min(job.max_interval, max(job.min_interval, e["interval"] * factor)), 1)
+    e["next_due"] = now + e["interval"] * 60
+    e["polls"] += 1
+    e["changes"] += int(changed)
+    e["history"] = (e["history"] + [[int(now), int(changed)]])[-HISTORY_LEN:]
+    return e
+
+
+def change_rate(entry):
+    """Доля опросов с изменениями по последним HISTORY_LEN опросам."""
+    history = entry.get("history", [])
+    return sum(c for _, c in history) / len(history) if history else None
+
+
+def tick(jobs, parallel=None, dry_run=False):
+    from sync_runner import run_jobs, DEFAULT_PARALLEL
+
+    now = time.time()
+    state = load_state()
+    due = [job for job in jobs if is_due(state, job, now)]
+    changed, idle = [], []
+    versions_known = True
+    if due:
+        try:
+            versions = drive_versions(authorize(), sorted({src.ss_id for job in due for src in job.sources}))
+        except Exception as e:
+            logging.warning(f"Drive version check failed ({e}), running every due job, intervals unchanged")
+            versions, versions_known = {}, False
+        for job in due:
+            (idle if sources_unchanged(job.name, versions) else changed).append(job)
+        # запущенные джобы наблюдают staleness сами (source_versions), idle — здесь
+        if not dry_run:
+            for job in idle:
+                observe_staleness(job.name, versions)
+
+    rc, results = 0, []
+    if changed and not dry_run:
+        rc = run_jobs(changed, parallel=parallel or DEFAULT_PARALLEL, results=results)
+    failed = {r["job"] for r in results if not r["ok"]}
+    if not dry_run:
+        for job in due:
+            record_poll(state, job, (job in changed) if versions_known else None, now, failed=job.name in failed)
+        save_state(state)
+
+    print(f"\n== Tick: {len(due)} due, {len(changed)} changed, {len(idle)} idle{' (dry run)' if dry_run else ''}")
+    for job in jobs:
+        e = _entry(state, job)
+        rate = change_rate(e)
+        status = "fail" if job.name in failed else "run" if job in changed else "idle" if job in idle else "wait"
+        print(f"  {job.name:<28} {status:<5} every {e['interval']:>7.1f} min "
+              f"[{job.min_interval}..{job.max_interval}]  next in {max(0, e['next_due'] - now) / 60:>6.1f} min  "
+              f"changes {'—' if rate is None else f'{rate:.0%}'}")
+    if not dry_run:
+        report_freshness(jobs)
+    return rc
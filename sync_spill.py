@@ -0,0 +1,190 @@
+#!/usr/bin/env python3
+"""
+Склейка источников с дедупликацией по приоритету в пределах бюджета памяти.
+
+Пока источники помещаются в SYNC_MEMORY_BUDGET_MB (с запасом на копии concat /
+sort / drop_duplicates), всё делается в памяти, как раньше. Как только бюджет
+превышен, накопленные и следующие источники сбрасываются на диск:
+  • упорядоченные прогоны по CHUNK_ROWS строк — для выдачи результата по порядку;
+  • hash-партиции по ключу дедупликации — дубликаты всегда в одной партиции.
+Партиции дедуплицируются группами, влезающими в бюджет, с тем же порядком
+«приоритет источника → порядок добавления → позиция строки»; выжившие строки
+отмечаются в битовой маске источника, и результат отдаётся кусками в исходном
+порядке — писатель получает поток, а в памяти одновременно только партиция
+или кусок.
+
+Файлы на диске — Arrow IPC (feather, читается через memory map); pyarrow
+есть в requirements.txt, pickle — только запасной вариант без него.
+"""
+import os
+import shutil
+import logging
+import tempfile
+
+import numpy as np
+import pandas as pd
+
+from sync_parallel import hash_rows, duplicated
+
+# —————————————————————————————
+MEMORY_BUDGET    = int(float(os.environ.get("SYNC_MEMORY_BUDGET_MB", "1024")) * 2**20)
+SPILL_PARTITIONS = int(os.environ.get("SYNC_SPILL_PARTITIONS", "64"))
+CHUNK_ROWS       = int(os.environ.get("SYNC_SPILL_CHUNK_ROWS", "50000"))
+SPILL_DIR        = os.environ.get("SYNC_SPILL_DIR") or None      # None — системный tmp
+COPIES           = 4        # источники + concat + сортированная + дедуплицированная копия
+# —————————————————————————————
+
+try:
+    import pyarrow  # noqa: F401
+    SPILL_FORMAT = "feather"
+except ImportError:
+    SPILL_FORMAT = "pickle"
+
+
+def frame_bytes(df):
+    return int(df.memory_usage(index=False, deep=True).sum())
+
+
+def _write_run(df, path):
+    if SPILL_FORMAT == "feather":
+        df.reset_index(drop=True).to_feather(path)
+    else:
+        df.to_pickle(path)
+
+
+def _read_run(path):
+    if SPILL_FORMAT == "feather":
+        return pd.read_feather(path, memory_map=True)
+    return pd.read_pickle(path)
+
+
+class SpillDedupe:
+    """
+    add(df, prio) для каждого источника в порядке чтения, затем chunks() —
+    результат concat → stable sort по prio → drop_duplicates(subset, keep)
+    кусками по порядку. Закрывать через close() / with.
+    """
+
+    def __init__(self, columns, subset=None, keep="first", budget=MEMORY_BUDGET,
+                 partitions=SPILL_PARTITIONS, chunk_rows=CHUNK_ROWS):
+        self.columns = list(columns)
+        self.names = [f"c{i}" for i in range(len(self.columns))]   # feather требует уникальные строковые имена
+        subset = self.columns if subset is None else subset
+        self.subset = [self.names[self.columns.index(c)] for c in subset]
+        self.keep = keep
+        self.budget = budget
+        self.partitions = partitions
+        self.chunk_rows = chunk_rows
+        self.held = []             # [(prio, seq, df)] — пока в бюджете
+        self.held_bytes = 0
+        self.sources = []          # [(prio, rows, [пути упорядоченных прогонов])]
+        self.dir = None
+        self.rows_in = 0
+        self.rows_out = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        if self.dir is not None:
+            shutil.rmtree(self.dir, ignore_errors=True)
+            self.dir = None
+
+    @property
+    def spilled(self):
+        return self.dir is not None
+
+    def add(self, df, prio):
+        seq = len(self.sources)
+        self.sources.append((prio, len(df), []))
+        self.rows_in += len(df)
+        size = frame_bytes(df)
+        if not self.spilled and (self.held_bytes + size) * COPIES <= self.budget:
+            self.held.append((prio, seq, df.set_axis(self.names, axis=1)))
+            self.held_bytes += size
+            return
+        if not self.spilled:
+            self.dir = tempfile.mkdtemp(prefix="sync-spill-", dir=SPILL_DIR)
+            logging.info(f"→ Sources exceed the memory budget ({(self.held_bytes + size) * COPIES / 2**20:.0f} MB "
+                         f"est. > {self.budget / 2**20:.0f} MB), spilling to {self.dir} ({SPILL_FORMAT})")
+            for held in self.held:
+                self._spill(*held)
+            self.held, self.held_bytes = [], 0
+        self._spill(prio, seq, df)
+
+    def _spill(self, prio, seq, df):
+        """
+        Источник на диск срезами по chunk_rows: упорядоченный прогон и hash-партиции
+        строятся из среза, так что сверх самого источника в памяти — копии одного среза.
+        """
+        runs = self.sources[seq][2]
+        for i, start in enumerate(range(0, len(df), self.chunk_rows)):
+            piece = df.iloc[start:start + self.chunk_rows].set_axis(self.names, axis=1)
+            path = os.path.join(self.dir, f"src{seq}_{len(runs)}.run")
+            _write_run(piece, path)
+            runs.append(path)
+
+            tagged = piece.assign(_prio=prio, _seq=seq, _pos=np.arange(start, start + len(piece), dtype=np.int64))
+            part = hash_rows(piece[self.subset], as_str=False) % np.uint64(self.partitions)
+            for p, frame in tagged.groupby(part, sort=False):
+                _write_run(frame, os.path.join(self.dir, f"part{int(p)}_{seq}_{i}.run"))
+
+    def _in_memory(self):
+        if not self.held:
+            return
+        df = pd.concat([d.assign(_prio=p) for p, _, d in self.held], ignore_index=True)
+        self.held = []
+        df = df.sort_values("_prio", kind="stable", ignore_index=True)
+        df = df[~duplicated(df, self.subset, self.keep)].drop(columns="_prio").reset_index(drop=True)
+        self.rows_out = len(df)
+        yield df.set_axis(self.columns, axis=1)
+
+    def _partition_groups(self):
+        """Партиции группами, чьи файлы вместе влезают в бюджет (с запасом на сортировку)."""
+        files = {}
+        for name in os.listdir(self.dir):
+            if name.startswith("part"):
+                files.setdefault(int(name[4:].split("_")[0]), []).append(os.path.join(self.dir, name))
+        group, size = [], 0
+        for p in sorted(files):
+            p_size = sum(os.path.getsize(f) for f in files[p])
+            if group and (size + p_size) * COPIES > self.budget:
+                yield group
+                group, size = [], 0
+            group += files[p]
+            size += p_size
+        if group:
+            yield group
+
+    def _survivors(self):
+        masks = [np.zeros(rows, dtype=bool) for _, rows, _ in self.sources]
+        for paths in self._partition_groups():
+            df = pd.concat([_read_run(p) for p in paths], ignore_index=True)
+            df = df.sort_values(["_prio", "_seq", "_pos"], kind="stable", ignore_index=True)
+            df = df[~duplicated(df, self.subset, self.keep)]
+            for seq, pos in df.groupby("_seq", sort=False)["_pos"]:
+                masks[int(seq)][pos.to_numpy()] = True
+        return masks
+
+    def _external(self):
+        masks = self._survivors()
+        order = sorted(range(len(self.sources)), key=lambda s: (self.sources[s][0], s))
+        for seq in order:
+            start = 0
+            for path in self.sources[seq][2]:
+                chunk = _read_run(path)
+                keep = masks[seq][start:start + len(chunk)]
+                start += len(chunk)
+                if keep.any():
+                    chunk = chunk[keep].reset_index(drop=True)
+                    self.rows_out += len(chunk)
+                    yield chunk.set_axis(self.columns, axis=1)
+
+    def chunks(self):
+        """Результат по порядку: один кадр в памяти или куски до chunk_rows строк после сброса на диск."""
+        yield from (self._external() if self.spilled else self._in_memory())
+        logging.info(f"✔ Dedupe: {self.rows_in} → {self.rows_out} rows"
+                     f"{' (external, ' + str(self.partitions) + ' partitions)' if self.spilled else ''}")
@@ -0,0 +1,223 @@
+#!/usr/bin/env python3
+"""
+Локальная копия результатов джобов в SQLite с индексами по ключевым
+колонкам (JobSpec.key_cols): точечный поиск без обращений к Sheets API.
+
+Обновляется из capture_changes дельтой прогона (удаляем removed + старые
+версии modified, вставляем added + новые версии), при первом прогоне или
+смене колонок таблица перезаливается целиком.
+
+    python sync_store.py tables
+    python sync_store.py get rates-update 12345 [--col "Tutor ID"]
+    python sync_store.py sql "SELECT count(*) FROM \"update_tutors\""
+    python sync_store.py serve [--port 8765]      # GET /rates-update?Tutor%20ID=12345
+"""
+import os
+import sys
+import json
+import time
+import sqlite3
+import logging
+import argparse
+import threading
+from contextlib import closing
+from urllib.parse import urlparse, parse_qsl, unquote
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from sheets_io import STATE_DIR
+from sync_parallel import hash_rows
+
+# —————————————————————————————
+STORE_PATH   = os.environ.get("SYNC_STORE_PATH", os.path.join(STATE_DIR, "store.sqlite"))
+DEFAULT_PORT = 8765
+MAX_ROWS_OUT = 1000     # ответ get/serve
+# —————————————————————————————
+
+_write_lock = threading.Lock()
+
+
+def _q(name):
+    return '"' + str(name).replace('"', '""') + '"'
+
+
+def _connect(readonly=False):
+    if readonly:
+        if not os.path.exists(STORE_PATH):
+            raise SystemExit(f"❌ Store {STORE_PATH} does not exist yet — run a sync first")
+        conn = sqlite3.connect(f"file:{STORE_PATH}?mode=ro", uri=True, check_same_thread=False)
+    else:
+        os.makedirs(os.path.dirname(STORE_PATH) or ".", exist_ok=True)
+        conn = sqlite3.connect(STORE_PATH, timeout=30)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("CREATE TABLE IF NOT EXISTS _meta (job TEXT PRIMARY KEY, columns TEXT, "
+                     "key_cols TEXT, rows INTEGER, updated_at TEXT)")
+    conn.row_factory = sqlite3.Row
+    return conn
+
+
+def _row_hashes(df):
+    return hash_rows(df).view("int64").tolist()
+
+
+def _rows(df):
+    """Значения как TEXT (None для пустых) + хэш строки в последней колонке."""
+    values = df.astype(object).where(df.notna(), None).to_numpy().tolist()
+    return [[None if v is None else str(v) for v in row] + [h] for row, h in zip(values, _row_hashes(df))]
+
+
+def _recreate(conn, job, columns, key_names):
+    conn.execute(f"DROP TABLE IF EXISTS {_q(job)}")
+    conn.execute(f"CREATE TABLE {_q(job)} ({', '.join(f'{_q(c)} TEXT' for c in columns)}, _row INTEGER)")
+    conn.execute(f"CREATE INDEX {_q(f'ix_{job}__row')} ON {_q(job)} (_row)")
+    for name in key_names:
+        conn.execute(f"CREATE INDEX {_q(f'ix_{job}_{name}')} ON {_q(job)} ({_q(name)})")
+
+
+def apply_delta(job, chunks, delta, total, key_cols=None, full=False):
+    """
+    Обновляет таблицу джоба: full=True — перезаливка из chunks (кадры результата
+    по порядку, читаются только тут), иначе применяем Delta. total — строк в результате.
+    """
+    from sync_cdc import unique_columns
+
+    columns = unique_columns(delta.added)
+    key_names = [columns[i] for i in key_cols or []]
+    placeholders = ", ".join("?" * (len(columns) + 1))
+    started = time.perf_counter()
+
+    with _write_lock, closing(_connect()) as conn, conn:
+        meta = conn.execute("SELECT columns FROM _meta WHERE job = ?", (job,)).fetchone()
+        if full or meta is None or json.loads(meta["columns"]) != columns:
+            _recreate(conn, job, columns, key_names)
+            for chunk in chunks:
+                conn.executemany(f"INSERT INTO {_q(job)} VALUES ({placeholders})", _rows(chunk))
+            mode = "reload"
+        else:
+            stale = _row_hashes(delta.removed) + _row_hashes(delta.modified_old)
+            conn.executemany(f"DELETE FROM {_q(job)} WHERE rowid = "
+                             f"(SELECT rowid FROM {_q(job)} WHERE _row = ? LIMIT 1)", [(h,) for h in stale])
+            conn.executemany(f"INSERT INTO {_q(job)} VALUES ({placeholders})",
+                             _rows(delta.added) + _rows(delta.modified))
+            mode = "delta"
+        rows = conn.execute(f"SELECT count(*) FROM {_q(job)}").fetchone()[0]
+        conn.execute("INSERT OR REPLACE INTO _meta VALUES (?, ?, ?, ?, datetime('now'))",
+                     (job, json.dumps(columns, ensure_ascii=False), json.dumps(key_names, ensure_ascii=False), rows))
+    if rows != total:
+        logging.warning(f"⚠ Store {job}: {rows} rows after {mode}, expected {total} — next run reloads")
+        invalidate(job)
+    else:
+        logging.info(f"✔ Store {job}: {mode}, {rows} rows in {time.perf_counter() - started:.2f}s")
+
+
+def invalidate(job):
+    """Следующий apply_delta перезальёт таблицу джоба целиком."""
+    with _write_lock, closing(_connect()) as conn, conn:
+        conn.execute("DELETE FROM _meta WHERE job = ?", (job,))
+
+
+def tables():
+    with closing(_connect(readonly=True)) as conn:
+        return [dict(r) for r in conn.execute("SELECT * FROM _meta ORDER BY job")]
+
+
+def lookup(job, value, col=None, conn=None):
+    """Строки джоба, где колонка col (по умолчанию — первая ключевая) равна value."""
+    own = conn is None
+    conn = conn or _connect(readonly=True)
+    try:
+        meta = conn.execute("SELECT columns, key_cols FROM _meta WHERE job = ?", (job,)).fetchone()
+        if meta is None:
+            raise KeyError(f"unknown job {job}")
+        columns = json.loads(meta["columns"])
+        col = col or (json.loads(meta["key_cols"]) or columns)[0]
+        if col not in columns:
+            raise KeyError(f"unknown column {col}")
+        cur = conn.execute(f"SELECT * FROM {_q(job)} WHERE {_q(col)} = ? LIMIT {MAX_ROWS_OUT}", (str(value),))
+        return [{k: r[k] for k in r.keys() if k != "_row"} for r in cur]
+    finally:
+        if own:
+            conn.close()
+
+
+def query(sql, conn=None):
+    own = conn is None
+    conn = conn or _connect(readonly=True)
+    try:
+        return [dict(r) for r in conn.execute(sql).fetchmany(MAX_ROWS_OUT)]
+    finally:
+        if own:
+            conn.close()
+
+
+class _Handler(BaseHTTPRequestHandler):
+    """GET /<job>?<column>=<value> → JSON; GET / → список таблиц. Только чтение."""
+
+    conn = None
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        job = unquote(url.path.strip("/"))
+        try:
+            if not job:
+                body = [dict(r) for r in self.conn.execute("SELECT * FROM _meta ORDER BY job")]
+            else:
+                params = parse_qsl(url.query)
+                if len(params) != 1:
+                    raise KeyError("expected exactly one ?column=value")
+                col, value = params[0]
+                body = lookup(job, value, col, conn=self.conn)
+            status = 200
+        except (KeyError, sqlite3.Error) as e:
+            body, status = {"error": str(e)}, 404
+        data = json.dumps(body, ensure_ascii=False).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, fmt, *args):
+        logging.info(fmt % args)
+
+
+def serve(port=DEFAULT_PORT, host="127.0.0.1"):
+    _Handler.conn = _connect(readonly=True)
+    server = ThreadingHTTPServer((host, port), _Handler)
+    logging.info(f"✔ Serving {STORE_PATH} read-only on http://{host}:{port}/")
+    server.serve_forever()
+
+
+def main(argv=None):
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+    parser = argparse.ArgumentParser(description="Read-only queries against the local copy of job outputs")
+    sub = parser.add_subparsers(dest="command", required=True)
+    sub.add_parser("tables", help="list jobs in the store")
+    p_get = sub.add_parser("get", help="point lookup by key column")
+    p_get.add_argument("job")
+    p_get.add_argument("value")
+    p_get.add_argument("--col", help="column name (default: first key column)")
+    p_sql = sub.add_parser("sql", help="run a read-only SQL query")
+    p_sql.add_argument("sql")
+    p_serve = sub.add_parser("serve", help="read-only HTTP lookups on localhost")
+    p_serve.add_argument("--port", type=int, default=DEFAULT_PORT)
+    args = parser.parse_args(argv)
+
+    if args.command == "serve":
+        serve(args.port)
+        return 0
+    try:
+        if args.command == "tables":
+            result = tables()
+        elif args.command == "get":
+            result = lookup(args.job, args.value, args.col)
+        else:
+            result = query(args.sql)
+    except (KeyError, sqlite3.Error) as e:
+        print(f"❌ {e}")
+        return 1
+    print(json.dumps(result, ensure_ascii=False, indent=1))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
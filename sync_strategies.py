@@ -0,0 +1,270 @@
+#!/usr/bin/env python3
+"""
+Выбор способа чтения источника по истории: batch_get колонок (для высоких
+листов — параллельно по шардам строк), потоковый values.get или CSV-экспорт.
+По каждой паре (источник, способ) храним долю успехов и латентность (EWMA)
+в STATE_DIR/strategies.json и первым пробуем способ с наименьшей ожидаемой
+ценой latency / success. Если он не ответил за RACE_FACTOR × свою обычную
+латентность, параллельно запускаем следующий — берём первый успешный ответ.
+Упавший способ сразу уступает место следующему.
+
+Результат любого способа приводится normalize_frame к одному виду: первая
+строка листа — заголовок (пустой заголовок — ""), колонки cols в заданном
+порядке, все значения — строки ("" для пустых), строки до последней, где
+непуста хотя бы одна из cols. Так в целевой лист попадает одно и то же,
+какой бы способ ни выиграл.
+"""
+import os
+import io
+import json
+import time
+import atexit
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+import pandas as pd
+from gspread.utils import rowcol_to_a1
+
+from sheets_io import (
+    STATE_DIR, CALL_TIMEOUT_CAP, DeadlineExceeded, read_call, retry_read, ws_ss_id, http_client, stream_columns,
+)
+from sync_profile import attach
+
+# —————————————————————————————
+STATS_PATH      = os.path.join(STATE_DIR, "strategies.json")
+EWMA_ALPHA      = 0.3
+DEFAULT_LATENCY = 10.0     # сек — для способа без истории
+RACE_FACTOR     = 2.0
+RACE_MIN_DELAY  = 2.0
+MIN_SUCCESS     = 0.05
+EXPORT_URL      = "https://docs.google.com/spreadsheets/d/{}/export"
+
+SHARD_ROWS      = int(os.environ.get("SHEETS_SHARD_ROWS", "50000"))   # строк в шарде batch_get
+SHARD_WORKERS   = int(os.environ.get("SHEETS_SHARD_WORKERS", "4"))
+SHARD_ATTEMPTS  = 3
+# —————————————————————————————
+
+
+class StrategyStats:
+    """{источник: {способ: {"success": EWMA, "latency": EWMA сек, "n": число попыток}}}."""
+
+    def __init__(self, path=STATS_PATH):
+        self.path = path
+        self.lock = threading.Lock()
+        try:
+            with open(path, encoding="utf-8") as f:
+                self.data = json.load(f)
+        except (OSError, ValueError):
+            self.data = {}
+
+    def record(self, source, strategy, ok, seconds):
+        with self.lock:
+            s = self.data.setdefault(source, {}).setdefault(strategy, {"success": 1.0, "latency": None, "n": 0})
+            s["success"] = round((1 - EWMA_ALPHA) * s["success"] + EWMA_ALPHA * (1.0 if ok else 0.0), 4)
+            if ok:
+                s["latency"] = round(seconds if s["latency"] is None
+                                     else (1 - EWMA_ALPHA) * s["latency"] + EWMA_ALPHA * seconds, 3)
+            s["n"] += 1
+
+    def latency(self, source, strategy):
+        s = self.data.get(source, {}).get(strategy)
+        return DEFAULT_LATENCY if not s or s["latency"] is None else s["latency"]
+
+    def cost(self, source, strategy):
+        s = self.data.get(source, {}).get(strategy)
+        success = 1.0 if not s else max(MIN_SUCCESS, s["success"])
+        return self.latency(source, strategy) / success
+
+    def rank(self, source, names):
+        # при равной цене (нет истории) сохраняем порядок, заданный вызывающим
+        return sorted(names, key=lambda name: self.cost(source, name))
+
+    def save(self):
+        try:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            with self.lock, open(self.path, "w", encoding="utf-8") as f:
+                json.dump(self.data, f, indent=1, sort_keys=True)
+        except OSError as e:
+            logging.warning(f"Could not save read strategy stats: {e}")
+
+
+STATS = StrategyStats()
+atexit.register(STATS.save)
+
+_race_pool = ThreadPoolExecutor(max_workers=8, thread_name_prefix="strategy")
+_shard_pool = ThreadPoolExecutor(max_workers=max(1, SHARD_WORKERS), thread_name_prefix="shard")
+
+
+def _frame(header, columns):
+    return pd.DataFrame(dict(enumerate(columns)), columns=range(len(header))).set_axis(header, axis=1)
+
+
+def normalize_frame(df):
+    """Единое правило строк и заголовков для всех способов (см. docstring модуля)."""
+    header = ["" if pd.isna(h) else str(h) for h in df.columns]
+    df = df.astype(object).where(df.notna(), "").astype(str)
+    filled = (df != "").to_numpy().any(axis=1)
+    last = int(filled.nonzero()[0][-1]) + 1 if filled.any() else 0
+    out = df.iloc[:last].reset_index(drop=True).set_axis(header, axis=1)
+    out.attrs.update(df.attrs)
+    return out
+
+
+def batch_get_columns(ws, cols, deadline=None):
+    """Колонки диапазонами A1:A одним batch_get; короткие колонки добиваем пустыми."""
+    letters = ["".join(filter(str.isalpha, rowcol_to_a1(1, c + 1))) for c in cols]
+    batch = read_call(lambda: ws.batch_get([f"{l}1:{l}" for l in letters]),
+                      f"batch_get:{ws_ss_id(ws)}", deadline, ws.client)
+    flat = [[r[0] if r else "" for r in col] for col in batch]
+    flat += [[] for _ in range(len(cols) - len(flat))]
+    n = max((len(c) for c in flat), default=0)
+    flat = [c + [""] * (n - len(c)) for c in flat]
+    header = [c[0] if c else "" for c in flat]
+    return _frame(header, [c[1:] for c in flat])
+
+
+def shard_ranges(row_count, shard_rows=SHARD_ROWS):
+    """[(первая строка, последняя строка)] по сетке листа, 1-based включительно."""
+    return [(start, min(start + shard_rows - 1, row_count)) for start in range(1, max(row_count, 1) + 1, shard_rows)]
+
+
+def _fetch_shard(ws, letters, start, end, deadline):
+    """Один шард всех колонок; ретраи только этого шарда."""
+    batch = retry_read(lambda: read_call(lambda: ws.batch_get([f"{l}{start}:{l}{end}" for l in letters]),
+                                         f"batch_get_shard:{ws_ss_id(ws)}", deadline, ws.client),
+                       f"Shard rows {start}-{end}", deadline, SHARD_ATTEMPTS, ws=ws)
+    n = end - start + 1
+    flat = [[r[0] if r else "" for r in col] for col in batch]
+    flat += [[] for _ in range(len(letters) - len(flat))]
+    return [c + [""] * (n - len(c)) for c in flat]
+
+
+def sharded_batch_get_columns(ws, cols, deadline=None, shard_rows=SHARD_ROWS):
+    """
+    Высокий лист: сетку (ws.row_count из метаданных) режем на шарды по shard_rows
+    строк, шарды качаются параллельно под общим лимитером квоты, каждый со своими
+    ретраями, и склеиваются по порядку в одни буферы колонок.
+    """
+    letters = ["".join(filter(str.isalpha, rowcol_to_a1(1, c + 1))) for c in cols]
+    shards = shard_ranges(ws.row_count, shard_rows)
+    futures = [_shard_pool.submit(attach(_fetch_shard), ws, letters, start, end, deadline) for start, end in shards]
+    columns = [[] for _ in cols]
+    for fut in futures:
+        for column, part in zip(columns, fut.result()):
+            column.extend(part)
+
+    # хвост сетки без данных отрезаем: строки до последней непустой хотя бы в одной колонке
+    last = max((max((i for i, v in enumerate(c) if v != ""), default=-1) for c in columns), default=-1)
+    for column in columns:
+        del column[last + 1:]
+    logging.info(f"batch_get in {len(shards)} shards of {shard_rows} rows → {max(last, 0)} data rows")
+    header = [c[0] if c else "" for c in columns]
+    return _frame(header, [c[1:] for c in columns])
+
+
+def csv_columns(ws, cols, deadline=None):
+    """CSV-экспорт листа через ту же авторизованную сессию, проекция на cols."""
+    session = http_client(ws.client).session
+    timeout = deadline.timeout() if deadline is not None else CALL_TIMEOUT_CAP
+    resp = read_call(lambda: session.get(EXPORT_URL.format(ws_ss_id(ws)),
+                                         params={"format": "csv", "gid": ws.id}, timeout=(10, timeout)),
+                     f"csv_export:{ws_ss_id(ws)}", deadline, ws.client)
+    resp.raise_for_status()
+    df = pd.read_csv(io.BytesIO(resp.content), header=None, dtype=str, keep_default_na=False)
+    columns = [df.iloc[:, c].tolist() if c < df.shape[1] else [""] * len(df) for c in cols]
+    header = [c[0] if c else "" for c in columns]
+    return _frame(header, [c[1:] for c in columns])
+
+
+def values_stream_columns(ws, cols, deadline=None):
+    return stream_columns(ws, cols, deadline)
+
+
+def default_strategies(ws, cols, deadline=None):
+    """
+    Способы в порядке по умолчанию; листы выше SHARD_ROWS строк по умолчанию читаем шардами.
+    У каждого способа свои ретраи 429/5xx с бэкоффом или переездом на другой аккаунт пула
+    (у шардов — на шард), к следующему способу переходим после неретраибельной ошибки,
+    исчерпанных попыток или по медленности.
+    """
+    strategies = {
+        "batch_get": lambda: retry_read(lambda: batch_get_columns(ws, cols, deadline), "batch_get", deadline, ws=ws),
+        "values_stream": lambda: values_stream_columns(ws, cols, deadline),
+        "csv_export": lambda: retry_read(lambda: csv_columns(ws, cols, deadline), "CSV export", deadline, ws=ws),
+    }
+    if ws.row_count > SHARD_ROWS:
+        strategies = {"batch_get_sharded": lambda: sharded_batch_get_columns(ws, cols, deadline), **strategies}
+    return strategies
+
+
+def _timed(source, name, fn):
+    started = time.monotonic()
+    try:
+        result = fn()
+    except BaseException:
+        STATS.record(source, name, False, time.monotonic() - started)
+        raise
+    STATS.record(source, name, True, time.monotonic() - started)
+    return result
+
+
+def read_with_strategies(source, strategies, deadline=None):
+    """
+    source — ключ статистики ("<ss_id>/<лист>"), strategies — {имя: fn()}.
+    Возвращает результат первого успешного способа.
+    """
+    order = STATS.rank(source, list(strategies))
+    logging.info(f"→ Read strategies for {source}: {' > '.join(order)}")
+    running, errors = {}, {}
+
+    def start(name):
+        running[_race_pool.submit(attach(_timed), source, name, strategies[name])] = name
+
+    start(order.pop(0))
+    while running:
+        # следующему способу даём стартовать, если текущие «зависли» дольше обычного
+        if order:
+            slowest = max(STATS.latency(source, n) for n in running.values())
+            timeout = max(RACE_MIN_DELAY, RACE_FACTOR * slowest)
+        else:
+            timeout = None
+        if deadline is not None:
+            remaining = max(0.0, deadline.remaining())
+            timeout = remaining if timeout is None else min(timeout, remaining)
+        done, _ = wait(running, timeout=timeout, return_when=FIRST_COMPLETED)
+
+        for fut in done:
+            name = running.pop(fut)
+            if fut.exception() is None:
+                logging.info(f"✔ {source}: read via {name}")
+                STATS.save()
+                return fut.result()
+            errors[name] = fut.exception()
+            logging.warning(f"{source}: {name} failed ({fut.exception()})")
+            if order:
+                start(order.pop(0))
+
+        if not done:
+            if deadline is not None and deadline.remaining() <= 0:
+                break
+            if order:
+                name = order.pop(0)
+                logging.info(f"{source}: {', '.join(running.values())} slow, racing {name}")
+                start(name)
+
+    STATS.save()
+    if errors and not running:
+        raise next(reversed(errors.values()))
+    raise DeadlineExceeded(f"{source}: no read strategy answered within the deadline")
+
+
+def read_columns(ws, cols, deadline=None, prefer=None):
+    """
+    Колонки cols листа ws самым надёжным/быстрым для этого источника способом.
+    prefer — способ, который пробовать первым, пока по источнику нет истории.
+    """
+    strategies = default_strategies(ws, cols, deadline)
+    if prefer:
+        strategies = {prefer: strategies.pop(prefer), **strategies}
+    return normalize_frame(read_with_strategies(f"{ws_ss_id(ws)}/{ws.title}", strategies, deadline))
@@ -0,0 +1,193 @@
+#!/usr/bin/env python3
+"""
+Дешёвая проверка «менялись ли источники»: один запрос к Drive
+files.get?fields=modifiedTime,version (несколько файлов — одним batch-запросом)
+до любых open_by_key/batch_get. Если версии всех источников джоба совпадают
+с версиями последней успешной синхронизации, джоб можно не запускать —
+но только если последним в целевой лист писал он сам и дописал до конца:
+update_groups, очистивший Tutors, или упавшая посреди записи попытка
+пропуск отменяют. Последний писатель листа — в том же versions.json
+("_writers"), поэтому .sync_state должен быть общим для всех workflow.
+
+SYNC_FORCE=1 отключает пропуск.
+
+Попутно каждая проверка версий — наблюдение staleness для sync_freshness,
+а mark_synced фиксирует время публикации.
+"""
+import os
+import re
+import json
+import time
+import uuid
+import logging
+import threading
+
+from sheets_io import STATE_DIR, DRIVE_FILES, read_call, http_client
+from sync_jobs import get_job
+from sync_freshness import observe, record_sync
+
+# —————————————————————————————
+VERSIONS_PATH  = os.path.join(STATE_DIR, "versions.json")
+WRITERS_KEY    = "_writers"   # "ss_id/sheet" → последний писатель листа {"job", "done", "at"}
+DRIVE_BATCH    = "https://www.googleapis.com/batch/drive/v3"
+DRIVE_FIELDS   = "id,modifiedTime,version"
+BATCH_MAX      = 100      # лимит Drive batch
+CACHE_TTL      = 60.0     # сек — runner делает один batch на все джобы, скрипты берут из кэша
+FORCE          = os.environ.get("SYNC_FORCE", "0") == "1"
+# —————————————————————————————
+
+_cache = {}
+_cache_lock = threading.Lock()
+_state_lock = threading.Lock()
+
+
+def _parse_batch(resp):
+    """multipart/mixed ответ Drive batch → список JSON-тел частей."""
+    m = re.search(r"boundary=([^;]+)", resp.headers.get("Content-Type", ""))
+    if not m:
+        raise ValueError("batch response without boundary")
+    boundary = m.group(1).strip('"')
+    bodies = []
+    for part in resp.text.split(f"--{boundary}"):
+        start, end = part.find("{"), part.rfind("}")
+        if start != -1 and end > start:
+            bodies.append(json.loads(part[start:end + 1]))
+    return bodies
+
+
+def _fetch_batch(client, ids, deadline):
+    boundary = f"batch_{uuid.uuid4().hex}"
+    parts = []
+    for i, file_id in enumerate(ids):
+        parts.append(
+            f"--{boundary}\r\nContent-Type: application/http\r\nContent-ID: <{i}>\r\n\r\n"
+            f"GET /drive/v3/files/{file_id}?fields={DRIVE_FIELDS}&supportsAllDrives=true\r\n\r\n"
+        )
+    body = ("".join(parts) + f"--{boundary}--\r\n").encode()
+    resp = read_call(lambda: http_client(client).request(
+        "post", DRIVE_BATCH, data=body,
+        headers={"Content-Type": f"multipart/mixed; boundary={boundary}"},
+    ), "drive_batch", deadline, client, hedge=False, quota=False)
+    return [b for b in _parse_batch(resp) if "id" in b]
+
+
+def _fetch_one(client, file_id, deadline):
+    resp = read_call(lambda: http_client(client).request(
+        "get", DRIVE_FILES.format(file_id),
+        params={"fields": DRIVE_FIELDS, "supportsAllDrives": True},
+    ), "drive_get", deadline, client, hedge=False, quota=False)
+    return resp.json()
+
+
+def drive_versions(client, ids, deadline=None):
+    """
+    {file_id: {"modifiedTime": ..., "version": ...}} для списка файлов.
+    Несколько файлов — одним batch-запросом; при ошибке batch — по одному.
+    Ошибки не фатальны: файла просто не будет в ответе (= считаем изменённым).
+    """
+    now = time.monotonic()
+    with _cache_lock:
+        result = {i: v for i, (t, v) in _cache.items() if i in ids and now - t < CACHE_TTL}
+    missing = sorted(set(ids) - set(result))
+
+    fetched = []
+    for chunk in (missing[i:i + BATCH_MAX] for i in range(0, len(missing), BATCH_MAX)):
+        try:
+            fetched.extend(_fetch_batch(client, chunk, deadline) if len(chunk) > 1
+                           else [_fetch_one(client, chunk[0], deadline)])
+        except Exception as e:
+            logging.warning(f"Drive batch metadata failed ({e}), falling back to single requests")
+            for file_id in chunk:
+                try:
+                    fetched.append(_fetch_one(client, file_id, deadline))
+                except Exception as e1:
+                    logging.warning(f"Drive files.get {file_id} failed: {e1}")
+
+    with _cache_lock:
+        for meta in fetched:
+            v = {"modifiedTime": meta.get("modifiedTime"), "version": meta.get("version")}
+            _cache[meta["id"]] = (time.monotonic(), v)
+            result[meta["id"]] = v
+    return result
+
+
+def _load_state():
+    try:
+        with open(VERSIONS_PATH, encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def _save_state(state):
+    os.makedirs(os.path.dirname(VERSIONS_PATH) or ".", exist_ok=True)
+    tmp = VERSIONS_PATH + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(state, f, indent=1, sort_keys=True)
+    os.replace(tmp, VERSIONS_PATH)
+
+
+def _dest_id(job_name):
+    dest = get_job(job_name).dest
+    return f"{dest.ss_id}/{dest.sheet}"
+
+
+def claim_destination(job_name):
+    """Перед очисткой целевого листа: пишет этот джоб, запись ещё не закончена."""
+    with _state_lock:
+        state = _load_state()
+        state.setdefault(WRITERS_KEY, {})[_dest_id(job_name)] = {"job": job_name, "done": False, "at": round(time.time(), 1)}
+        _save_state(state)
+
+
+def source_versions(client, job_name, deadline=None):
+    ids = sorted({src.ss_id for src in get_job(job_name).sources})
+    versions = drive_versions(client, ids, deadline)
+    observe_staleness(job_name, versions)
+    return versions
+
+
+def observe_staleness(job_name, versions):
+    """
+    Насколько вкладка джоба отстаёт от источников по версиям Drive — в историю свежести.
+    Без версии хотя бы одного источника (Drive не ответил) не наблюдаем: иначе запишется ложный 0.
+    """
+    ids = {src.ss_id for src in get_job(job_name).sources}
+    if not ids or not ids <= versions.keys():
+        logging.info(f"→ No Drive versions for some sources of {job_name}, skipping freshness observation")
+        return
+    try:
+        observe(job_name, {i: v for i, v in versions.items() if i in ids}, _load_state().get(job_name, {}))
+    except Exception as e:
+        logging.warning(f"Freshness observation for {job_name} failed: {e}")
+
+
+def sources_unchanged(job_name, versions):
+    """
+    True, если у всех источников та же version, что при последней успешной синхронизации,
+    и после неё в целевой лист никто другой не писал.
+    """
+    if FORCE:
+        return False
+    ids = {src.ss_id for src in get_job(job_name).sources}
+    state = _load_state()
+    last = state.get(job_name, {})
+    writer = state.get(WRITERS_KEY, {}).get(_dest_id(job_name), {})
+    if writer.get("job") != job_name or not writer.get("done"):
+        if writer:
+            logging.info(f"→ '{get_job(job_name).dest.sheet}' last written by {writer.get('job')}"
+                         f"{'' if writer.get('done') else ' (unfinished)'}, not skipping {job_name}")
+        return False
+    return bool(ids) and all(
+        i in versions and i in last and versions[i]["version"] == last[i]["version"] for i in ids
+    )
+
+
+def mark_synced(job_name, versions):
+    """Запоминаем версии, прочитанные ДО загрузки данных — правки во время прогона не потеряются."""
+    with _state_lock:
+        state = _load_state()
+        state[job_name] = versions
+        state.setdefault(WRITERS_KEY, {})[_dest_id(job_name)] = {"job": job_name, "done": True, "at": round(time.time(), 1)}
+        _save_state(state)
+    record_sync(job_name, versions)
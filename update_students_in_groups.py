@@ -2,18 +2,26 @@
 import os
 import json
 import logging
-import time
 
-import pandas as pd
 import gspread
 from oauth2client.service_account import ServiceAccountCredentials
-from gspread_dataframe import set_with_dataframe
-from gspread.exceptions import APIError
+
+from sync_cdc import capture_changes
+from sync_versions import source_versions, sources_unchanged, mark_synced, claim_destination
+from sync_filters import filtered_read
+from sync_strategies import read_columns
+from sync_profile import profile_job
+from sheets_io import (
+    Deadline, api_retry_open, api_retry_worksheet, destination_lock, write_call, write_dataframe,
+)
 
 # —————————————————————————————
 # Константы
+JOB_NAME = "update_students_in_groups"
+
 SRC_SS_ID       = "1XwyahhHC7uVzwfoErrvwrcruEjwewqIUp2u-6nvdSR0"
 SRC_SHEET_TITLE = "data"
+SRC_COLS        = [1, 13, 14, 3]  # B, N, O, D
 
 DST_SS_ID       = "16QrbLtzLTV6GqyT8HYwzcwYIsXewzjUbM0Jy5i1fENE"
 DST_SHEET_TITLE = "Students"
@@ -22,20 +30,10 @@ DST_SHEET_TITLE = "Students"
 # Логирование
 logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
 
-def fetch_with_retries(ws, attempts=5, backoff=1.0):
-    """Чтение get_all_values с retry при APIError(503)."""
-    for i in range(1, attempts+1):
-        try:
-            logging.info(f"Чтение исходных данных, попытка {i}/{attempts}")
-            return ws.get_all_values()
-        except APIError as e:
-            if i == attempts or e.response.status_code != 503:
-                logging.error(f"Ошибка при чтении листа: {e}")
-                raise
-            logging.warning(f"503 — ждем {backoff}s")
-            time.sleep(backoff)
-            backoff *= 2
-    raise RuntimeError("Не удалось прочитать лист после retry")
+def read_frame(ws, deadline=None):
+    """Колонки SRC_COLS (первая строка — заголовок), по умолчанию потоковым values.get; None, если данных нет."""
+    df = read_columns(ws, SRC_COLS, deadline, prefer="values_stream")
+    return None if df.empty else df
 
 def main():
     # 1) Авторизация
@@ -46,27 +44,36 @@ def main():
     )
     client = gspread.authorize(creds)
     logging.info("✔ Авторизованы в Google Sheets")
+    deadline = Deadline.from_env(JOB_NAME)
+
+    # Источники не менялись с прошлой успешной синхронизации — не читаем и не пишем
+    src_versions = source_versions(client, JOB_NAME, deadline)
+    if sources_unchanged(JOB_NAME, src_versions):
+        logging.info("✔ Sources unchanged since last sync — skipping fetch and write")
+        return
 
     # 2) Читаем исходный лист
-    sh_src = client.open_by_key(SRC_SS_ID)
-    ws_src = sh_src.worksheet(SRC_SHEET_TITLE)
-    data = fetch_with_retries(ws_src)
-    if not data or len(data) < 2:
+    sh_src = api_retry_open(client, SRC_SS_ID, deadline)
+    ws_src = api_retry_worksheet(sh_src, SRC_SHEET_TITLE, deadline)
+    # 3) Берём колонки B, N, O, D и фильтруем по B содержит COL|CHI|ESP (RowFilter в sync_jobs)
+    df = filtered_read(JOB_NAME, 0, ws_src, lambda: read_frame(ws_src, deadline), deadline)
+    if df is None or df.empty:
         logging.error("Исходный лист пуст или нет строк")
         return
-
-    # 3) Формируем DataFrame и фильтруем по B содержит COL|CHI|ESP
-    header = data[0]
-    df_all = pd.DataFrame(data[1:], columns=header)
-    df = df_all.iloc[:, [1, 13, 14, 3]]
     logging.info(f"→ Отобрано {len(df)} строк с колонками B и N")
     
     # 4) Пишем в целевой лист
-    sh_dst = client.open_by_key(DST_SS_ID)
-    ws_dst = sh_dst.worksheet(DST_SHEET_TITLE)
-    ws_dst.batch_clear(['A:D'])
-    set_with_dataframe(ws_dst, df)
+    sh_dst = api_retry_open(client, DST_SS_ID, deadline, write=True)
+    ws_dst = api_retry_worksheet(sh_dst, DST_SHEET_TITLE, deadline)
+    with destination_lock(DST_SS_ID, DST_SHEET_TITLE):
+        write_deadline = deadline.write_phase()   # до очистки: хватит ли бюджета, дальше — свой
+        claim_destination(JOB_NAME)   # с этого момента лист наш, пока не mark_synced
+        write_call(lambda: ws_dst.batch_clear(['A:D']), write_deadline, ws_dst.client)
+        write_dataframe(ws_dst, df, deadline=write_deadline, compact=True)
+    capture_changes(JOB_NAME, df)
+    mark_synced(JOB_NAME, src_versions)
     logging.info(f"✔ Записано в '{DST_SHEET_TITLE}': {len(df)} строк")
 
 if __name__ == "__main__":
-    main()
+    with profile_job(JOB_NAME):
+        main()
@@ -2,17 +2,22 @@
 import os
 import json
 import logging
-import time
 
-import pandas as pd
 import gspread
 from oauth2client.service_account import ServiceAccountCredentials
-from gspread_dataframe import set_with_dataframe
-from gspread.exceptions import APIError, WorksheetNotFound
-from gspread.utils import rowcol_to_a1
-from itertools import zip_longest
+
+from sync_cdc import capture_changes
+from sync_versions import source_versions, sources_unchanged, mark_synced, claim_destination
+from sync_filters import filtered_read
+from sync_strategies import read_columns
+from sync_profile import profile_job
+from sheets_io import (
+    Deadline, api_retry_open, api_retry_worksheet, destination_lock, write_call, write_dataframe,
+)
 
 # —————————————————————————————
+JOB_NAME = "update_tutors"
+
 SOURCE_SS_ID      = "1xqGCXsebSmYL4bqAwvTmD9lOentI45CTMxhea-ZDFls"
 SOURCE_SHEET_NAME = "Tutors"
 
@@ -23,82 +28,6 @@ DEST_SHEET_NAME   = "Tutors"
 logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
 
 
-def api_retry_open(client, key, max_attempts=5, backoff=1.0):
-    for i in range(1, max_attempts+1):
-        try:
-            logging.info(f"open_by_key attempt {i}/{max_attempts}")
-            return client.open_by_key(key)
-        except APIError as e:
-            code = getattr(e.response, "status_code", None) or getattr(e.response, "status", None)
-            if code and 500 <= int(code) < 600 and i < max_attempts:
-                logging.warning(f"Received {code} — retrying in {backoff:.1f}s")
-                time.sleep(backoff)
-                backoff *= 2
-                continue
-            raise
-
-
-def api_retry_worksheet(sh, title, max_attempts=5, backoff=1.0):
-    for i in range(1, max_attempts+1):
-        try:
-            logging.info(f"worksheet('{title}') attempt {i}/{max_attempts}")
-            return sh.worksheet(title)
-        except APIError as e:
-            code = getattr(e.response, "status_code", None) or getattr(e.response, "status", None)
-            if code and 500 <= int(code) < 600 and i < max_attempts:
-                logging.warning(f"Received {code} — retrying in {backoff:.1f}s")
-                time.sleep(backoff)
-                backoff *= 2
-                continue
-            raise
-        except WorksheetNotFound:
-            logging.error(f"Worksheet '{title}' not found")
-            raise
-
-
-def fetch_columns(ws, cols_idx, max_attempts=5, backoff=1.0):
-    """
-    Скачиваем только нужные колонки (0-based indices) через batch_get().
-    """
-    for attempt in range(1, max_attempts + 1):
-        try:
-            ranges = []
-            for idx in cols_idx:
-                a1 = rowcol_to_a1(1, idx + 1)
-                col = ''.join(filter(str.isalpha, a1))
-                ranges.append(f"{col}1:{col}")
-
-            batch = ws.batch_get(ranges)
-
-            cols = [[row[0] if row else "" for row in col] for col in batch]
-            logging.info(f"Column lengths incl header: {[len(c) for c in cols]}")
-
-            headers = []
-            value_cols = []
-
-            for i, c in enumerate(cols):
-                header = c[0] if c else f"col_{cols_idx[i] + 1}"
-                headers.append(header)
-                value_cols.append(c[1:] if len(c) > 1 else [])
-
-            data = list(zip_longest(*value_cols, fillvalue=""))
-            df = pd.DataFrame(data, columns=headers)
-
-            logging.info(f"Fetched dataframe shape: {df.shape}")
-            logging.info(f"Fetched dataframe head:\n{df.head(3).to_string(index=False)}")
-
-            return df
-
-        except Exception as e:
-            if attempt < max_attempts:
-                logging.warning(f"batch_get error (attempt {attempt}): {e} — retrying in {backoff:.1f}s")
-                time.sleep(backoff)
-                backoff *= 2
-                continue
-            logging.error(f"batch_get failed after {attempt} attempts: {e}")
-            raise
-
-
 def main():
     # 1) Авторизация
     scope   = ["https://spreadsheets.google.com/feeds", "https://www.googleapis.com/auth/drive"]
@@ -107,26 +36,39 @@ def main():
               )
     client  = gspread.authorize(creds)
     logging.info("✔ Authenticated to Google Sheets")
+    deadline = Deadline.from_env(JOB_NAME)
+
+    # Источники не менялись с прошлой успешной синхронизации — не читаем и не пишем
+    src_versions = source_versions(client, JOB_NAME, deadline)
+    if sources_unchanged(JOB_NAME, src_versions):
+        logging.info("✔ Sources unchanged since last sync — skipping fetch and write")
+        return
 
     # 2) Открываем исходный лист
-    sh_src = api_retry_open(client, SOURCE_SS_ID)
-    ws_src = api_retry_worksheet(sh_src, SOURCE_SHEET_NAME)
+    sh_src = api_retry_open(client, SOURCE_SS_ID, deadline)
+    ws_src = api_retry_worksheet(sh_src, SOURCE_SHEET_NAME, deadline)
 
     # 3) Тянем только нужные колонки
     cols_to_take = [0, 1, 2, 21, 4, 15, 16]  # A, B, C, V, E, P, Q
-    df = fetch_columns(ws_src, cols_to_take)
+    df = filtered_read(JOB_NAME, 0, ws_src, lambda: read_columns(ws_src, cols_to_take, deadline), deadline)
     logging.info(f"→ Fetched columns {cols_to_take}, resulting shape={df.shape}")
 
     # 4) Запись в целевой лист
     if df.empty:
         raise RuntimeError("Source dataframe is empty. Aborting before clearing destination sheet.")
     
-    sh_dst = api_retry_open(client, DEST_SS_ID)
-    ws_dst = api_retry_worksheet(sh_dst, DEST_SHEET_NAME)
-    ws_dst.batch_clear(["A:G"])
-    set_with_dataframe(ws_dst, df)
+    sh_dst = api_retry_open(client, DEST_SS_ID, deadline, write=True)
+    ws_dst = api_retry_worksheet(sh_dst, DEST_SHEET_NAME, deadline)
+    with destination_lock(DEST_SS_ID, DEST_SHEET_NAME):
+        write_deadline = deadline.write_phase()   # до очистки: хватит ли бюджета, дальше — свой
+        claim_destination(JOB_NAME)   # с этого момента лист наш, пока не mark_synced
+        write_call(lambda: ws_dst.batch_clear(["A:G"]), write_deadline, ws_dst.client)
+        write_dataframe(ws_dst, df, deadline=write_deadline)
+    capture_changes(JOB_NAME, df)
+    mark_synced(JOB_NAME, src_versions)
     logging.info(f"✔ Written to '{DEST_SHEET_NAME}' — {df.shape[0]} rows")
 
 
 if __name__ == "__main__":
-    main()
+    with profile_job(JOB_NAME):
+        main()